@@ -12,7 +12,7 @@ if getattr(sys, 'frozen', False):
 from PyQt5.QtWidgets import QApplication
 from engine import create_engine
 from mainwindow import MainWindow
-from utils import setup_logging
+from utils import setup_logging, stop_logging
 import logging
 
 log = logging.getLogger('app')
@@ -37,4 +37,5 @@ if __name__ == '__main__':
     engine.join()
 
     # quit
+    stop_logging()
     sys.exit(rc)
@@ -0,0 +1,226 @@
+"""Encoder throughput benchmark.
+
+Generates deterministic synthetic sources with ffmpeg's lavfi test
+sources, runs each encoding profile over them through encode_item(),
+and reports fps, cpu seconds per frame and output bitrate as json.
+Run from the top-level directory so config.ini is picked up:
+
+    $ python traumenc/bench_encode.py --sizes hd,uhd -o bench.json
+    $ python traumenc/bench_encode.py --baseline bench.json
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import socket
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from config import config
+
+# keep benchmark runs out of the encode history
+config['history']['enabled'] = 'no'
+
+import engine
+from encodingprofiles import encoding_profiles
+from profiling import get_child_cpu_time
+
+log = logging.getLogger('bench.encode')
+
+bench_sizes = {
+    'hd': (1920, 1080),
+    'uhd': (3840, 2160),
+    '4k': (4096, 2160),
+    }
+
+bench_framerate = ('fps_24', (24, 1))
+
+# source name -> (lavfi source, container/image format, is sequence)
+bench_sources = {
+    'testsrc2': ('testsrc2', 'mkv', False),
+    'mandelbrot': ('mandelbrot', 'mkv', False),
+    'png': ('testsrc2', 'png', True),
+    'dpx': ('testsrc2', 'dpx', True),
+    'exr': ('testsrc2', 'exr', True),
+    }
+
+
+def ffmpeg_run(cmd):
+    program = engine.get_ffmpeg_bin('ffmpeg')
+    args = shlex.split(f'{program} -v error -y {cmd}')
+    subprocess.run(args, check=True, capture_output=True)
+
+def get_ffmpeg_version():
+    program = engine.get_ffmpeg_bin('ffmpeg')
+    out = subprocess.run(shlex.split(f'{program} -version'), capture_output=True, encoding='utf8').stdout
+    return out.splitlines()[0] if out else ''
+
+def make_source(dirpath, name, size, frames):
+    lavfi, fmt, is_sequence = bench_sources[name]
+    w, h = size
+    rate = bench_framerate[1][0]
+    # the length is an output option, not every source takes a duration
+    inspec = f'-f lavfi -i {lavfi}=size={w}x{h}:rate={rate}'
+
+    if is_sequence:
+        # one folder per sequence, so each scan finds a single item
+        seqdir = os.path.join(dirpath, f'{name}_{w}x{h}')
+        os.makedirs(seqdir, exist_ok=True)
+        pix_fmt = {'exr': 'gbrpf32le', 'dpx': 'rgb48le'}.get(fmt, 'rgb24')
+        ffmpeg_run(f'{inspec} -frames:v {frames} -pix_fmt {pix_fmt} -start_number 1 "{seqdir}/frame.%04d.{fmt}"')
+        return seqdir
+    else:
+        filepath = os.path.join(dirpath, f'{name}_{w}x{h}.{fmt}')
+        ffmpeg_run(f'{inspec} -frames:v {frames} -codec:v ffv1 "{filepath}"')
+        return filepath
+
+def scan_source(path):
+    before = set(engine.media_items)
+    engine.scan_paths([path], bench_framerate[1])
+    ids = [id for id in engine.media_items if id not in before]
+    if len(ids) != 1:
+        raise RuntimeError(f'expected one item from {path}, found {len(ids)}')
+    return ids[0]
+
+def bench_encode(id, profile, outdir, frames):
+    item = engine.media_lookup(id)
+    outpath = os.path.join(outdir, f'{id}_{profile}.mov')
+
+    cpu0 = get_child_cpu_time()
+    t0 = time.perf_counter()
+    engine.encode_item(id, profile, bench_framerate[0], outpath=outpath)
+    wall = time.perf_counter() - t0
+    cpu = get_child_cpu_time() - cpu0
+
+    item = engine.media_lookup(id)
+    if item['state'] != 'done':
+        raise RuntimeError(f'encode failed: {item["path"]} {profile}')
+
+    # the sources are made with -frames:v, at the bench rate. the
+    # probed count can't be relied on, mkv has no stream duration
+    num, den = bench_framerate[1]
+    seconds = frames * den / num
+    nbytes = os.path.getsize(outpath)
+    os.remove(outpath)
+
+    return {
+        'frames': frames,
+        'wall_time': round(wall, 4),
+        'fps': round(frames / wall, 3) if wall else None,
+        'cpu_per_frame': round(cpu / frames, 5) if cpu and frames else None,
+        'bytes': nbytes,
+        'mbps': round(nbytes * 8 / seconds / 1e6, 3) if seconds else None,
+        }
+
+def run_benchmark(sizes, sources, profiles, frames, workdir):
+    results = []
+    srcdir = os.path.join(workdir, 'src')
+    outdir = os.path.join(workdir, 'out')
+    os.makedirs(srcdir, exist_ok=True)
+    os.makedirs(outdir, exist_ok=True)
+
+    for size_name in sizes:
+        size = bench_sizes[size_name]
+        for source in sources:
+            log.info(f'creating {source} {size_name}')
+            try:
+                path = make_source(srcdir, source, size, frames)
+            except subprocess.CalledProcessError as e:
+                # eg. no exr encoder in this ffmpeg build
+                log.warning(f'skipping {source} {size_name}: {e.stderr.strip()}')
+                continue
+
+            id = scan_source(path)
+            for profile in profiles:
+                log.info(f'encoding {source} {size_name} {profile}')
+                result = {
+                    'key': f'{source}/{size_name}/{profile}',
+                    'source': source,
+                    'size': size_name,
+                    'resolution': list(size),
+                    'profile': profile,
+                    }
+                result.update(bench_encode(id, profile, outdir, frames))
+                log.info(f'  {result["fps"]:.1f} fps, {result["mbps"]:.1f} Mbps')
+                results.append(result)
+
+    return results
+
+def compare_with_baseline(results, baseline, threshold):
+    """Print fps relative to the baseline, return number of regressions.
+    """
+    base = {r['key']: r for r in baseline['results']}
+    regressions = 0
+    print(f'{"benchmark":40} {"base fps":>10} {"fps":>10} {"change":>8}')
+    for r in results:
+        b = base.get(r['key'])
+        if not b:
+            print(f'{r["key"]:40} {"-":>10} {r["fps"]:10.2f}')
+            continue
+        change = r['fps'] / b['fps'] - 1.0
+        flag = ''
+        if change < -threshold:
+            flag = ' REGRESSION'
+            regressions += 1
+        print(f'{r["key"]:40} {b["fps"]:10.2f} {r["fps"]:10.2f} {100*change:+7.1f}%{flag}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Encoder throughput benchmark.')
+    parser.add_argument('--sizes', default='hd,uhd,4k',
+        help=f'comma separated ({",".join(bench_sizes)})')
+    parser.add_argument('--sources', default=','.join(bench_sources),
+        help=f'comma separated ({",".join(bench_sources)})')
+    parser.add_argument('--profiles', default=','.join(encoding_profiles),
+        help='comma separated profile ids')
+    parser.add_argument('--frames', type=int, default=48, help='frames per source')
+    parser.add_argument('-o', '--output', help='write results json here')
+    parser.add_argument('--baseline', help='compare with a previous results json')
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help='fractional fps drop reported as a regression (default 0.1)')
+    parser.add_argument('--workdir', help='keep sources here instead of a temp dir')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(name)-14s %(message)s')
+    logging.getLogger('engine').setLevel(logging.WARNING)
+
+    sizes = args.sizes.split(',')
+    sources = args.sources.split(',')
+    profiles = args.profiles.split(',')
+
+    with tempfile.TemporaryDirectory(prefix='traumenc-bench-') as tempdir:
+        workdir = args.workdir or tempdir
+        results = run_benchmark(sizes, sources, profiles, args.frames, workdir)
+
+    ob = {
+        'meta': {
+            'time': time.time(),
+            'host': socket.gethostname(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'ffmpeg': get_ffmpeg_version(),
+            'frames': args.frames,
+            },
+        'results': results,
+        }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(ob, f, indent=2)
+    else:
+        json.dump(ob, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_with_baseline(results, baseline, args.threshold):
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""Media list model benchmark.
+
+Feeds synthetic media updates through MediaListModel the way the main
+window does (batched per engine poll) and times inserts, progress
+updates, id lookups and removals, counting the model signals emitted.
+Run from the top-level directory so config.ini is picked up:
+
+    $ python traumenc/bench_model.py --items 100000 -o bench-model.json
+"""
+import sys
+import json
+import time
+import random
+import argparse
+
+from PyQt5.QtCore import QCoreApplication
+
+from medialist import MediaListModel
+
+
+def make_item(i, rng):
+    return {
+        'id': f'{i:08x}',
+        'type': 'sequence',
+        'path': f'/mnt/plates/reel{i // 1000:03}/shot{i:06}/plate.####.exr',
+        'displayname': f'shot{i:06}_plate.####.exr (1001-{1001 + rng.randrange(24, 500)})',
+        'duration': rng.uniform(1.0, 20.0),
+        'framerate': (24, 1),
+        'resolution': (4096, 2160),
+        'codec': 'exr',
+        'pixfmt': 'gbrapf32le',
+        'filesize': rng.randrange(1 << 28, 1 << 34),
+        'state': 'ready',
+        'progress': 0.0,
+        }
+
+def batches(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i+size]
+
+
+class SignalCounter(object):
+    def __init__(self, model):
+        self.counts = {}
+        for name in ('rowsInserted', 'rowsRemoved', 'dataChanged'):
+            getattr(model, name).connect(self._counter(name))
+
+    def _counter(self, name):
+        def count(*args):
+            self.counts[name] = self.counts.get(name, 0) + 1
+        return count
+
+    def take(self):
+        counts = self.counts
+        self.counts = {}
+        return counts
+
+
+def run_benchmark(num_items, batch_size, num_updates, remove_fraction, seed):
+    rng = random.Random(seed)
+    model = MediaListModel()
+    signals = SignalCounter(model)
+    results = {}
+
+    def stage(name, fn, ops):
+        t0 = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - t0
+        results[name] = {
+            'ops': ops,
+            'time': round(elapsed, 4),
+            'us_per_op': round(1e6 * elapsed / ops, 3) if ops else None,
+            'signals': signals.take(),
+            }
+
+    items = [make_item(i, rng) for i in range(num_items)]
+    ids = [item['id'] for item in items]
+
+    def insert():
+        for batch in batches(items, batch_size):
+            model._apply_updates(batch)
+    stage('insert', insert, num_items)
+
+    # progress updates arrive for a few encoding items at a time
+    updates = []
+    encoding = rng.sample(ids, 8)
+    for i in range(num_updates):
+        if i % 100 == 0:
+            encoding[rng.randrange(len(encoding))] = rng.choice(ids)
+        updates.append({'id': rng.choice(encoding), 'progress': rng.random()})
+
+    def progress_batched():
+        for batch in batches(updates, batch_size):
+            model._apply_updates(batch)
+    stage('progress_batched', progress_batched, num_updates)
+
+    def progress_single():
+        for data in updates:
+            model._update_item(data)
+    stage('progress_single', progress_single, num_updates)
+
+    def lookup():
+        for id in ids:
+            model._find_row_with_id(id)
+    stage('lookup', lookup, num_items)
+
+    remove_ids = rng.sample(ids, int(num_items * remove_fraction))
+
+    def remove():
+        for batch in batches(remove_ids, batch_size):
+            model._remove_items_by_id(batch)
+    stage('remove', remove, len(remove_ids))
+
+    # check the index survived the removals
+    for row, item in enumerate(model._items):
+        assert model._find_row_with_id(item['id']) == row
+    assert model.rowCount(None) == num_items - len(remove_ids)
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Media list model benchmark.')
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=500,
+        help='updates applied per engine poll')
+    parser.add_argument('--updates', type=int, default=20000, help='progress updates')
+    parser.add_argument('--remove', type=float, default=0.1, help='fraction of items removed')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help='write results json here')
+    args = parser.parse_args()
+
+    app = QCoreApplication(sys.argv)
+    results = run_benchmark(args.items, args.batch_size, args.updates, args.remove, args.seed)
+
+    ob = {
+        'params': vars(args),
+        'results': results,
+        }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(ob, f, indent=2)
+    else:
+        json.dump(ob, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
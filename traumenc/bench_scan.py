@@ -0,0 +1,263 @@
+"""Scan and ingest benchmark.
+
+Builds a synthetic directory tree of empty files (image sequences with
+gaps, videos and junk) and times scan_paths() stage by stage, with
+probing and thumbnailing stubbed out so no real media is needed.
+Run from the top-level directory so config.ini is picked up:
+
+    $ python traumenc/bench_scan.py --dirs 10000 --frames 2000000 -o scan.json
+    $ python traumenc/bench_scan.py --tree /tmp/scantree --baseline scan.json
+"""
+import os
+import sys
+import json
+import time
+import pickle
+import random
+import shutil
+import socket
+import logging
+import argparse
+import platform
+import tempfile
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from config import config
+
+config['history']['enabled'] = 'no'
+config['profile']['trace_file'] = ''
+# the files are all empty, so would all be duplicates
+config['dedupe']['enabled'] = 'no'
+
+import engine
+import profiling
+
+log = logging.getLogger('bench.scan')
+
+image_exts = ['exr', 'dpx', 'png', 'tif', 'jpg']
+video_exts = ['mov', 'mp4', 'mkv']
+junk_names = ['notes.txt', 'Thumbs.db', '.DS_Store', 'edl.xml', 'README', 'render.log']
+
+
+def touch(filepath):
+    os.close(os.open(filepath, os.O_CREAT | os.O_WRONLY, 0o644))
+
+def build_tree(root, dirs, frames, seq_length, gap_rate, videos, junk, seed):
+    """Create the tree, returns counts of what was created.
+    """
+    rng = random.Random(seed)
+    fanout = max(1, int(dirs ** 0.5))
+    dirpaths = []
+    for i in range(dirs):
+        dirpath = os.path.join(root, f'reel{i // fanout:03}', f'shot{i:05}')
+        os.makedirs(dirpath, exist_ok=True)
+        dirpaths.append(dirpath)
+
+    counts = {'dirs': dirs, 'frames': 0, 'sequences': 0, 'gaps': 0, 'videos': 0, 'junk': 0}
+
+    frames_per_dir = frames // dirs
+    for dirpath in dirpaths:
+        remaining = frames_per_dir
+        seq_index = 0
+        while remaining > 0:
+            length = min(remaining, max(2, int(rng.gauss(seq_length, seq_length / 4))))
+            ext = rng.choice(image_exts)
+            name = f'{os.path.basename(dirpath)}_v{seq_index:02}'
+            frame = 1001
+            for _ in range(length):
+                if rng.random() < gap_rate:
+                    # skip a frame
+                    frame += 1
+                    counts['gaps'] += 1
+                touch(os.path.join(dirpath, f'{name}.{frame:04}.{ext}'))
+                frame += 1
+            remaining -= length
+            counts['frames'] += length
+            counts['sequences'] += 1
+            seq_index += 1
+
+    for i in range(videos):
+        dirpath = rng.choice(dirpaths)
+        touch(os.path.join(dirpath, f'clip{i:05}.{rng.choice(video_exts)}'))
+        counts['videos'] += 1
+
+    for i in range(junk):
+        dirpath = rng.choice(dirpaths)
+        touch(os.path.join(dirpath, f'{i:05}_{rng.choice(junk_names)}'))
+        counts['junk'] += 1
+
+    return counts
+
+
+class CountingConn(object):
+    """Stands in for the client pipe, counting message volume.
+    """
+    def __init__(self):
+        self.messages = {}
+
+    def send(self, msg):
+        size = len(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
+        counts = self.messages.setdefault(msg[0], [0, 0])
+        counts[0] += 1
+        counts[1] += size
+
+    def poll(self, timeout=0.0):
+        return False
+
+
+def stub_probe_item(id):
+    engine.media_update(id,
+        codec='stub',
+        resolution=(1920, 1080),
+        pixfmt='yuv422p10',
+        duration=0.0,
+        filesize=0,
+        )
+    return True
+
+def stub_thumbnail_items(ids, size=(-1, 256)):
+    return set(ids)
+
+
+def get_peak_rss():
+    if not resource:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macos, kilobytes elsewhere
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def run_scan(root):
+    engine.probe_item = stub_probe_item
+    engine.thumbnail_items = stub_thumbnail_items
+    conn = CountingConn()
+    engine.engine_conn = conn
+    profiling.enabled = True
+
+    t0 = time.perf_counter()
+    engine.scan_paths([root], (24, 1))
+    elapsed = time.perf_counter() - t0
+
+    stages = {}
+    for name, (count, total, tmin, tmax) in profiling.stage_stats.items():
+        stages[name] = {'count': count, 'total': round(total, 4), 'max': round(tmax, 6)}
+
+    messages = {}
+    for name, (count, size) in conn.messages.items():
+        messages[name] = {'count': count, 'bytes': size}
+
+    types = {}
+    for item in engine.media_items.values():
+        types[item['type']] = types.get(item['type'], 0) + 1
+
+    return {
+        'total_time': round(elapsed, 4),
+        'items': types,
+        'stages': stages,
+        'messages': messages,
+        'message_bytes': sum(m['bytes'] for m in messages.values()),
+        'peak_rss': get_peak_rss(),
+        }
+
+def compare_with_baseline(result, baseline, threshold):
+    """Print stage times relative to the baseline, return number of regressions.
+    """
+    regressions = 0
+    rows = [('total', baseline['total_time'], result['total_time'])]
+    for name, stage in sorted(result['stages'].items()):
+        base = baseline['stages'].get(name)
+        rows.append((name, base['total'] if base else None, stage['total']))
+
+    print(f'{"stage":32} {"base s":>10} {"s":>10} {"change":>8}')
+    for name, base, value in rows:
+        if not base:
+            print(f'{name:32} {"-":>10} {value:10.3f}')
+            continue
+        change = value / base - 1.0
+        flag = ''
+        if change > threshold:
+            flag = ' REGRESSION'
+            regressions += 1
+        print(f'{name:32} {base:10.3f} {value:10.3f} {100*change:+7.1f}%{flag}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Scan and ingest benchmark.')
+    parser.add_argument('--dirs', type=int, default=200)
+    parser.add_argument('--frames', type=int, default=20000, help='total image files')
+    parser.add_argument('--seq-length', type=int, default=100, help='mean frames per sequence')
+    parser.add_argument('--gap-rate', type=float, default=0.001, help='chance of a missing frame')
+    parser.add_argument('--videos', type=int, default=100)
+    parser.add_argument('--junk', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--tree', help='build (or reuse) the tree here instead of a temp dir')
+    parser.add_argument('-o', '--output', help='write results json here')
+    parser.add_argument('--baseline', help='compare with a previous results json')
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help='fractional slowdown reported as a regression (default 0.1)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(name)-14s %(message)s')
+    logging.getLogger('engine').setLevel(logging.WARNING)
+
+    params = {k: getattr(args, k) for k in ('dirs', 'frames', 'seq_length', 'gap_rate', 'videos', 'junk', 'seed')}
+
+    tempdir = None
+    root = args.tree
+    if not root:
+        root = tempdir = tempfile.mkdtemp(prefix='traumenc-scan-')
+
+    # reuse an existing tree if it was built with the same parameters
+    paramspath = os.path.join(root, 'tree.json')
+    tree = None
+    if os.path.isfile(paramspath):
+        with open(paramspath) as f:
+            tree = json.load(f)
+        if tree['params'] != params:
+            raise SystemExit(f'{root} was built with different parameters')
+        log.info(f'reusing tree {root}')
+    else:
+        log.info(f'building tree {root}')
+        t0 = time.perf_counter()
+        counts = build_tree(root, **params)
+        log.info(f'built {counts} in {time.perf_counter() - t0:.1f}s')
+        tree = {'params': params, 'counts': counts}
+        with open(paramspath, 'w') as f:
+            json.dump(tree, f)
+
+    try:
+        log.info('scanning')
+        result = run_scan(root)
+    finally:
+        if tempdir:
+            shutil.rmtree(tempdir)
+
+    ob = {
+        'meta': {
+            'time': time.time(),
+            'host': socket.gethostname(),
+            'platform': platform.platform(),
+            },
+        'tree': tree,
+        }
+    ob.update(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(ob, f, indent=2)
+    else:
+        json.dump(ob, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare_with_baseline(ob, baseline, args.threshold):
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
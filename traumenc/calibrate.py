@@ -0,0 +1,204 @@
+"""Encoder calibration.
+
+Encodes a short synthetic clip with each available prores encoder for
+every profile, measuring speed, bitrate and quality (PSNR against the
+source). Results are stored per host in the calibration file, where
+profiles with codec='auto' pick the fastest encoder meeting their
+quality constraint. Run from the top-level directory so config.ini is
+picked up:
+
+    $ python traumenc/calibrate.py run --size uhd
+    $ python traumenc/calibrate.py show
+"""
+import os
+import re
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from config import config
+
+import engine
+import encodingprofiles
+from encodingprofiles import encoding_profiles, prores_encoders, get_calibration_key, get_profile_codec
+
+log = logging.getLogger('calibrate')
+
+cfg = config['calibration']
+
+calibration_sizes = {
+    'hd': (1920, 1080),
+    'uhd': (3840, 2160),
+    '4k': (4096, 2160),
+    }
+
+calibration_rate = 24
+
+re_psnr = re.compile(r'average:([\d.]+|inf)')
+
+
+def ffmpeg_run(args):
+    program = engine.get_ffmpeg_bin('ffmpeg')
+    return subprocess.run([program, '-hide_banner', '-y'] + args,
+        check=True, capture_output=True, encoding='utf8')
+
+def get_ffmpeg_version():
+    program = engine.get_ffmpeg_bin('ffmpeg')
+    out = subprocess.run([program, '-version'], capture_output=True, encoding='utf8').stdout
+    return out.splitlines()[0] if out else ''
+
+def get_available_encoders():
+    program = engine.get_ffmpeg_bin('ffmpeg')
+    out = subprocess.run([program, '-hide_banner', '-encoders'],
+        capture_output=True, encoding='utf8').stdout
+    names = set()
+    for line in out.splitlines():
+        fields = line.split()
+        if len(fields) > 1:
+            names.add(fields[1])
+    return [encoder for encoder in prores_encoders if encoder in names]
+
+def make_clip(filepath, size, frames):
+    w, h = size
+    ffmpeg_run([
+        '-f', 'lavfi', '-i', f'testsrc2=size={w}x{h}:rate={calibration_rate}',
+        '-frames:v', str(frames), '-pix_fmt', 'yuv444p10', '-codec:v', 'ffv1',
+        filepath])
+
+def measure_psnr(srcpath, outpath):
+    # compare in a common format, alpha is dropped
+    result = ffmpeg_run([
+        '-i', outpath, '-i', srcpath,
+        '-lavfi', '[0:v]format=yuv444p10[a];[1:v]format=yuv444p10[b];[a][b]psnr',
+        '-f', 'null', '-'])
+    m = re_psnr.search(result.stderr)
+    if not m:
+        return None
+    return float(m.group(1))
+
+def calibrate_encoder(srcpath, outdir, encoder, ffargs, frames):
+    outpath = os.path.join(outdir, f'{encoder}_{ffargs["profile"]}_{ffargs["pix_fmt"]}.mov')
+    t0 = time.perf_counter()
+    ffmpeg_run([
+        '-i', srcpath,
+        '-codec:v', encoder,
+        '-profile:v', str(ffargs['profile']),
+        '-vendor', ffargs['vendor'],
+        '-pix_fmt', ffargs['pix_fmt'],
+        outpath])
+    wall = time.perf_counter() - t0
+
+    nbytes = os.path.getsize(outpath)
+    psnr = measure_psnr(srcpath, outpath)
+    os.remove(outpath)
+
+    return {
+        'key': get_calibration_key(encoder, ffargs['profile'], ffargs['pix_fmt']),
+        'encoder': encoder,
+        'profile': ffargs['profile'],
+        'pix_fmt': ffargs['pix_fmt'],
+        'fps': round(frames / wall, 3),
+        'mbps': round(nbytes * 8 * calibration_rate / frames / 1e6, 3),
+        'psnr': psnr,
+        }
+
+def run_calibration(size, frames, encoders, workdir):
+    srcpath = os.path.join(workdir, 'calibration.mkv')
+    log.info(f'creating {size[0]}x{size[1]} clip')
+    make_clip(srcpath, size, frames)
+
+    # profiles share settings (eg. auto and fixed codec), only run each once
+    combos = {}
+    for profile in encoding_profiles.values():
+        ffargs = profile['ffargs']
+        combos[(ffargs['profile'], ffargs['pix_fmt'])] = ffargs
+
+    results = []
+    for ffargs in combos.values():
+        for encoder in encoders:
+            log.info(f'encoding {encoder} profile {ffargs["profile"]} {ffargs["pix_fmt"]}')
+            try:
+                result = calibrate_encoder(srcpath, workdir, encoder, ffargs, frames)
+            except subprocess.CalledProcessError as e:
+                # eg. a pix_fmt the encoder doesn't support
+                log.warning(f'skipping {encoder}: {e.stderr.strip().splitlines()[-1:]}')
+                continue
+            log.info(f'  {result["fps"]:.1f} fps, {result["mbps"]:.1f} Mbps, {result["psnr"]} dB')
+            results.append(result)
+    return results
+
+def load_calibration_file(filepath):
+    try:
+        with open(filepath) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'hosts': {}}
+
+def save_calibration_file(filepath, ob):
+    temppath = f'{filepath}.tmp'
+    with open(temppath, 'w') as f:
+        json.dump(ob, f, indent=2)
+    os.replace(temppath, filepath)
+
+def show_calibration():
+    results = encodingprofiles.load_calibration()
+    print(f'{"profile":18} {"encoder":10} {"fps":>9} {"Mbps":>9} {"psnr":>7}')
+    for id, profile in encoding_profiles.items():
+        ffargs = profile['ffargs']
+        codec = get_profile_codec(id)
+        for encoder in profile['encoders'] if ffargs['codec'] == 'auto' else [ffargs['codec']]:
+            result = results.get(get_calibration_key(encoder, ffargs['profile'], ffargs['pix_fmt']))
+            mark = '*' if encoder == codec else ' '
+            if not result:
+                print(f'{id:18} {encoder:10}{mark} {"-":>8}')
+                continue
+            print(f'{id:18} {encoder:10}{mark} {result["fps"]:8.1f} {result["mbps"]:9.1f} {result["psnr"] or 0:7.2f}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark prores encoders for codec=auto profiles.')
+    parser.add_argument('--file', help='calibration file (default from config)')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('run', help='run the benchmarks and store the results')
+    p.add_argument('--size', default='hd', choices=list(calibration_sizes))
+    p.add_argument('--frames', type=int, default=48)
+    sub.add_parser('show', help='print the results and the encoder chosen per profile')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(name)-14s %(message)s')
+    logging.getLogger('engine').setLevel(logging.WARNING)
+
+    if args.file:
+        cfg['file'] = args.file
+    filepath = cfg.get('file')
+
+    if args.command == 'run':
+        encoders = get_available_encoders()
+        if not encoders:
+            raise SystemExit('no prores encoders found in ffmpeg')
+
+        with tempfile.TemporaryDirectory(prefix='traumenc-calibrate-') as workdir:
+            results = run_calibration(calibration_sizes[args.size], args.frames, encoders, workdir)
+
+        ob = load_calibration_file(filepath)
+        ob.setdefault('hosts', {})[socket.gethostname()] = {
+            'time': time.time(),
+            'platform': platform.platform(),
+            'ffmpeg': get_ffmpeg_version(),
+            'size': args.size,
+            'frames': args.frames,
+            'results': results,
+            }
+        save_calibration_file(filepath, ob)
+        log.info(f'wrote {filepath}')
+
+    show_calibration()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
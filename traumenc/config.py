@@ -4,12 +4,22 @@ config = ConfigParser()
 
 config['ui'] = {
     'engine_poll_interval': 200,
+    'engine_drain_budget': 20,
     'details_style': 'long',
+    'render_cache_size': 1000,
+    'thumbnail_cache_size': 1000,
+    'thumbnail_prefetch_rows': 20,
+    'thumbnail_threads': 2,
     }
 
 config['engine'] = {
     'output_suffix': '_prores.mov',
     'ffmpeg_path': '',
+    'thumbnail_batch_size': 8,
+    'native_thumbnails': True,
+    'max_jobs': 1,
+    'max_jobs_per_device': 0,
+    'scratch_dir': '',
     }
 
 config['clique'] = {
@@ -17,12 +27,98 @@ config['clique'] = {
     'contiguous_only': True,
     }
 
+config['profile'] = {
+    'enabled': False,
+    'trace_file': 'trace.json',
+    'trace_events': 100000,
+    }
+
+config['history'] = {
+    'enabled': True,
+    'database': 'history.db',
+    'prometheus_file': '',
+    }
+
+config['governor'] = {
+    'enabled': False,
+    'min_jobs': 1,
+    'max_jobs': 0,
+    'target_load': 0.9,
+    'min_available_mb': 2048,
+    'max_memory_pressure': 10.0,
+    'max_io_pressure': 40.0,
+    'interval': 5.0,
+    }
+
+config['prefetch'] = {
+    'enabled': False,
+    'mode': 'fadvise',
+    'window': 24,
+    'threads': 4,
+    }
+
+config['verify'] = {
+    'enabled': False,
+    'checksum': 'md5',
+    'threads': 2,
+    'duration_tolerance': 0.05,
+    'manifest_dir': '',
+    }
+
+config['control'] = {
+    'enabled': False,
+    'address': 'traumenc.sock',
+    }
+
+config['calibration'] = {
+    'file': 'calibration.json',
+    }
+
+config['dedupe'] = {
+    'enabled': True,
+    'sample_blocks': 4,
+    'block_size_kb': 64,
+    'confirm': True,
+    }
+
+config['cache'] = {
+    'enabled': False,
+    'dir': '',
+    'max_size_gb': 100,
+    'hardlink': False,
+    'match_mtime': False,
+    }
+
+config['filmstrip'] = {
+    'enabled': False,
+    'frames': 8,
+    'height': 128,
+    'dir': 'filmstrips',
+    'cache_size': 100,
+    }
+
+config['sample'] = {
+    'frames': 48,
+    'position': 'start',
+    'max_jobs': 0,
+    'dir': '',
+    }
+
+config['preflight'] = {
+    'mode': 'warn',
+    'reserve_mb': 1024,
+    }
+
 config['log'] = {
     'stderr': False,
     'color': False,
     'file': '',
     'append': True,
     'level': 'debug',
+    'queue': True,
+    'rate_limit': 20,
+    'burst': 50,
+    'sample': 10,
     }
 
 config.read('config.ini')
@@ -0,0 +1,340 @@
+"""Local JSON-RPC control API.
+
+The engine can listen on a unix socket (or localhost tcp port) for
+newline delimited JSON-RPC 2.0 requests, so scripts can queue and track
+encodes alongside the ui. Clients call the engine commands and can
+subscribe to its events, which arrive as notifications:
+
+    $ python traumenc/control.py call scan_paths '{"paths": ["/mnt/shots"]}'
+    $ python traumenc/control.py call encode_items '{"ids": [], "profile": "prores_422_hq"}'
+    $ python traumenc/control.py watch media_update encode_complete
+
+The server is polled from the engine's own loop, no threads involved.
+"""
+import os
+import sys
+import json
+import base64
+import socket
+import logging
+import argparse
+import selectors
+
+from config import config
+
+log = logging.getLogger('engine.control')
+
+cfg = config['control']
+
+# drop clients that stop reading rather than buffer without limit
+max_send_buffer = 16 * 1024 * 1024
+max_request_size = 1024 * 1024
+
+# json-rpc errors
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+
+class InvalidParams(Exception):
+    pass
+
+
+def is_enabled():
+    return cfg.getboolean('enabled')
+
+def parse_address(address):
+    """'host:port' for tcp, anything else is a unix socket path.
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host or '127.0.0.1', int(port))
+    return address
+
+def json_default(value):
+    if isinstance(value, (bytes, bytearray)):
+        # thumbnails
+        return base64.b64encode(value).decode('ascii')
+    if isinstance(value, set):
+        return list(value)
+    return str(value)
+
+def encode_message(ob):
+    return json.dumps(ob, default=json_default).encode('utf8') + b'\n'
+
+
+class ControlClient(object):
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.recv_buffer = b''
+        self.send_buffer = bytearray()
+        self.subscriptions = None   # None: not subscribed, empty: everything
+        self.closed = False
+
+    def is_subscribed(self, event):
+        subs = self.subscriptions
+        return subs is not None and (not subs or event in subs)
+
+
+class ControlServer(object):
+    """Serves requests with handler(method, params), which returns the
+    result. check(method, params) raises InvalidParams for bad params,
+    before long running methods are acknowledged.
+    """
+    def __init__(self, address, handler, methods, check):
+        self.handler = handler
+        self.methods = methods
+        self.check = check
+        self.clients = []
+        self.selector = selectors.DefaultSelector()
+
+        self.address = parse_address(address)
+        if isinstance(self.address, tuple):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(self.address)
+        else:
+            # a stale socket from a previous run
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(self.address)
+            os.chmod(self.address, 0o600)
+
+        sock.listen(16)
+        sock.setblocking(False)
+        self.sock = sock
+        self.selector.register(sock, selectors.EVENT_READ)
+        log.info(f'control api listening on {self.address}')
+
+    def close(self):
+        for client in list(self.clients):
+            self._close_client(client)
+        self.selector.unregister(self.sock)
+        self.sock.close()
+        if not isinstance(self.address, tuple):
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
+
+    def get_sockets(self):
+        return [self.sock] + [client.sock for client in self.clients]
+
+    def has_pending_output(self):
+        return any(client.send_buffer for client in self.clients)
+
+    def poll(self, timeout=0):
+        """Handle any pending connections and requests.
+        """
+        requests = []
+        for key, mask in self.selector.select(timeout):
+            if key.fileobj is self.sock:
+                self._accept()
+                continue
+
+            client = key.data
+            if mask & selectors.EVENT_READ:
+                requests.extend((client, line) for line in self._read(client))
+            if mask & selectors.EVENT_WRITE and not client.closed:
+                self._flush(client)
+
+        # handlers can re-enter poll(), so read everything first
+        for client, line in requests:
+            if not client.closed:
+                self._handle_request(client, line)
+
+    def broadcast(self, event, *args):
+        message = None
+        for client in list(self.clients):
+            if client.is_subscribed(event):
+                if message is None:
+                    message = encode_message({'jsonrpc': '2.0', 'method': event, 'params': list(args)})
+                self._send(client, message)
+
+    def _accept(self):
+        try:
+            sock, address = self.sock.accept()
+        except OSError:
+            return
+        sock.setblocking(False)
+        client = ControlClient(sock, address)
+        self.clients.append(client)
+        self.selector.register(sock, selectors.EVENT_READ, client)
+        log.info(f'control client connected: {address or "local"}')
+
+    def _close_client(self, client):
+        if client.closed:
+            return
+        client.closed = True
+        self.clients.remove(client)
+        self.selector.unregister(client.sock)
+        client.sock.close()
+        log.info(f'control client disconnected: {client.address or "local"}')
+
+    def _read(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except OSError:
+            data = b''
+        if not data:
+            self._close_client(client)
+            return []
+
+        lines = (client.recv_buffer + data).split(b'\n')
+        client.recv_buffer = lines.pop()
+        if len(client.recv_buffer) > max_request_size:
+            log.warning('control request too large, disconnecting')
+            self._close_client(client)
+            return []
+        return [line for line in lines if line.strip()]
+
+    def _send(self, client, message):
+        if client.closed:
+            return
+        was_empty = not client.send_buffer
+        client.send_buffer += message
+        if len(client.send_buffer) > max_send_buffer:
+            log.warning('control client not reading, disconnecting')
+            self._close_client(client)
+            return
+        if was_empty:
+            self._flush(client)
+
+    def _flush(self, client):
+        try:
+            sent = client.sock.send(client.send_buffer)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self._close_client(client)
+            return
+        del client.send_buffer[:sent]
+
+        # wait for writable only while there's something left
+        events = selectors.EVENT_READ
+        if client.send_buffer:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(client.sock, events, client)
+
+    def _reply(self, client, id, result=None, error=None):
+        if id is None:
+            # a notification, no reply wanted
+            return
+        ob = {'jsonrpc': '2.0', 'id': id}
+        if error:
+            ob['error'] = {'code': error[0], 'message': error[1]}
+        else:
+            ob['result'] = result
+        self._send(client, encode_message(ob))
+
+    def _handle_request(self, client, line):
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            self._reply(client, 0, error=(PARSE_ERROR, str(e)))
+            return
+
+        if not isinstance(request, dict) or 'method' not in request:
+            self._reply(client, request.get('id', 0) if isinstance(request, dict) else 0,
+                error=(INVALID_REQUEST, 'invalid request'))
+            return
+
+        id = request.get('id')
+        method = request['method']
+        params = request.get('params') or {}
+        if not isinstance(params, dict):
+            self._reply(client, id, error=(INVALID_PARAMS, 'params must be an object'))
+            return
+
+        log.debug(f'control request: {method} {params}')
+
+        if method == 'subscribe':
+            events = params.get('events') or []
+            client.subscriptions = set(events)
+            self._reply(client, id, True)
+            return
+        if method == 'unsubscribe':
+            client.subscriptions = None
+            self._reply(client, id, True)
+            return
+
+        if method not in self.methods:
+            self._reply(client, id, error=(METHOD_NOT_FOUND, f'no method {method}'))
+            return
+
+        try:
+            self.check(method, params)
+        except InvalidParams as e:
+            log.warning(f'control request {method}: {e}')
+            self._reply(client, id, error=(INVALID_PARAMS, str(e)))
+            return
+
+        try:
+            if self.methods[method]:
+                # long running: acknowledge first, progress arrives as events
+                self._reply(client, id, None)
+                id = None
+            result = self.handler(method, params)
+        except Exception as e:
+            log.exception(f'control request failed: {method}')
+            self._reply(client, id, error=(INTERNAL_ERROR, str(e)))
+            return
+
+        self._reply(client, id, result)
+
+
+def connect(address=None):
+    address = parse_address(address or cfg.get('address'))
+    family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+def read_messages(sock):
+    buf = b''
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return
+        lines = (buf + data).split(b'\n')
+        buf = lines.pop()
+        for line in lines:
+            yield json.loads(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Control a running encoder.')
+    parser.add_argument('--address', help='socket path or host:port (default from config)')
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('call', help='call a method and print the result')
+    p.add_argument('method')
+    p.add_argument('params', nargs='?', default='{}', help='json object')
+    p = sub.add_parser('watch', help='print events as they arrive')
+    p.add_argument('events', nargs='*', help='events to watch (default all)')
+    args = parser.parse_args()
+
+    sock = connect(args.address)
+    if args.command == 'watch':
+        request = {'jsonrpc': '2.0', 'id': 1, 'method': 'subscribe', 'params': {'events': args.events}}
+    else:
+        request = {'jsonrpc': '2.0', 'id': 1, 'method': args.method, 'params': json.loads(args.params)}
+    sock.sendall(encode_message(request))
+
+    for message in read_messages(sock):
+        if args.command == 'watch':
+            if 'method' in message:
+                print(json.dumps(message), flush=True)
+        elif message.get('id') == 1:
+            print(json.dumps(message.get('result', message.get('error')), indent=2))
+            if 'error' in message:
+                return 1
+            return
+
+
+if __name__ == '__main__':
+    sys.exit(main())
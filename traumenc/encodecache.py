@@ -0,0 +1,117 @@
+"""Content-addressed encode cache.
+
+Outputs are kept under a key made from the source's content fingerprint,
+every source file's size (and optionally modification time), and the
+full encode settings, so a source moved, renamed or copied elsewhere
+and encoded the same way isn't encoded again. Hits are verified like
+encodes (when verification is on), which catches a sampled fingerprint
+matching different content, and entries that fail are discarded. Entries are files named by
+key, their mtime touched on every hit, and the least recently used are
+evicted when the cache grows past its size limit.
+"""
+import os
+import json
+import hashlib
+import logging
+
+from config import config
+from utils import format_size
+import publish
+
+log = logging.getLogger('engine.cache')
+
+cfg = config['cache']
+
+# bump when the key or what's stored changes
+cache_version = 3
+
+
+def is_enabled():
+    return cfg.getboolean('enabled') and bool(cfg.get('dir'))
+
+def get_key(fingerprint, settings):
+    ob = [cache_version, fingerprint, settings]
+    data = json.dumps(ob, sort_keys=True).encode('utf8')
+    return hashlib.sha256(data).hexdigest()
+
+def get_cache_path(key, ext='.mov'):
+    return os.path.join(cfg.get('dir'), key[:2], f'{key}{ext}')
+
+def lookup(key):
+    cachepath = get_cache_path(key)
+    try:
+        # most recently used
+        os.utime(cachepath)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        log.warning(f'cannot use cache entry {cachepath}: {e}')
+        return None
+    log.info(f'cache hit: {key}')
+    return cachepath
+
+def discard(key):
+    cachepath = get_cache_path(key)
+    try:
+        os.remove(cachepath)
+        log.info(f'discarded cache entry: {cachepath}')
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        log.warning(f'cannot discard cache entry {cachepath}: {e}')
+
+def fetch_output(cachepath, outpath):
+    """Produce an output from the cache, by reflink, hardlink (if
+    allowed) or copy.
+    """
+    partialpath = publish.get_partial_path(outpath)
+    try:
+        how = publish.clone_file(cachepath, partialpath, hardlink=cfg.getboolean('hardlink'))
+        os.replace(partialpath, outpath)
+    except OSError:
+        publish.remove_partial(partialpath)
+        raise
+    log.info(f'{how} from cache: {outpath}')
+
+def store_output(outpath, cachepath):
+    os.makedirs(os.path.dirname(cachepath), exist_ok=True)
+    partialpath = f'{cachepath}.partial'
+    try:
+        publish.clone_file(outpath, partialpath, hardlink=cfg.getboolean('hardlink'))
+        os.replace(partialpath, cachepath)
+    except OSError:
+        publish.remove_partial(partialpath)
+        raise
+    evict()
+
+def evict():
+    max_size = int(cfg.getfloat('max_size_gb') * 1024 ** 3)
+    entries = []
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(cfg.get('dir')):
+        for filename in filenames:
+            if filename.endswith('.partial'):
+                continue
+            filepath = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filepath))
+            total += st.st_size
+
+    if total <= max_size:
+        return
+
+    # least recently used first
+    entries.sort()
+    for mtime, size, filepath in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(filepath)
+        except OSError as e:
+            log.warning(f'cannot evict {filepath}: {e}')
+            continue
+        total -= size
+        log.info(f'evicted {filepath} ({format_size(size)})')
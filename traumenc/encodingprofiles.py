@@ -1,25 +1,107 @@
+import json
+import socket
+import logging
+
+from config import config
+
+log = logging.getLogger('engine.profiles')
+
 default_ffargs = {
     'codec': 'prores_ks',
     'vendor': 'ap10',
     'pix_fmt': 'yuv422p10',
     }
 
-def add_prores_profile(id, label, **kwargs):
+# nominal data rates are in Mbps for 1920x1080 at 29.97 fps, from the
+# apple prores white paper. prores is (roughly) constant bits per pixel,
+# so these scale to other resolutions and frame rates.
+nominal_pixel_rate = 1920 * 1080 * 30000 / 1001
+
+# ffmpeg's prores encoders, in order of preference when there's no
+# calibration to go by
+prores_encoders = ['prores_ks', 'prores_aw']
+
+def add_prores_profile(id, label, mbps, encoders=None, min_psnr=None, **kwargs):
+    # with codec='auto', the fastest calibrated encoder in encoders
+    # reaching min_psnr is used
     ffargs = default_ffargs.copy()
     ffargs.update(kwargs)
     encoding_profiles[id] = {
         'label': label,
         'ffargs': ffargs,
+        'mbps': mbps,
+        'encoders': encoders or prores_encoders,
+        'min_psnr': min_psnr,
+        # every frame a keyframe, so cheap enough to decode them all
+        # when verifying
+        'intra_only': True,
         }
 
 encoding_profiles = {}
 
-add_prores_profile('prores_422_proxy', 'ProRes 422 Proxy', profile=0)
-add_prores_profile('prores_422_lt', 'ProRes 422 LT', profile=1)
-add_prores_profile('prores_422', 'ProRes 422', profile=2)
-add_prores_profile('prores_422_hq', 'ProRes 422 HQ', profile=3)
-add_prores_profile('prores_4444', 'ProRes 4444', profile=4, pix_fmt='yuva444p10')
-add_prores_profile('prores_4444_xq', 'ProRes 4444 XQ', profile=5, pix_fmt='yuva444p10')
+add_prores_profile('prores_422_proxy', 'ProRes 422 Proxy', 45, profile=0, codec='auto', min_psnr=38)
+add_prores_profile('prores_422_lt', 'ProRes 422 LT', 102, profile=1, codec='auto', min_psnr=40)
+add_prores_profile('prores_422', 'ProRes 422', 147, profile=2)
+add_prores_profile('prores_422_hq', 'ProRes 422 HQ', 220, profile=3)
+add_prores_profile('prores_4444', 'ProRes 4444', 330, profile=4, pix_fmt='yuva444p10')
+add_prores_profile('prores_4444_xq', 'ProRes 4444 XQ', 500, profile=5, pix_fmt='yuva444p10')
+
+def get_profile_bytes_per_pixel(profile):
+    """Nominal output bytes per pixel per frame for a profile.
+    """
+    mbps = encoding_profiles[profile]['mbps']
+    return mbps * 1e6 / 8.0 / nominal_pixel_rate
+
+
+# encoder benchmarks from calibrate.py, for this host
+calibration = None
+
+def get_calibration_key(encoder, profile, pix_fmt):
+    return f'{encoder}/{profile}/{pix_fmt}'
+
+def load_calibration():
+    global calibration
+    if calibration is None:
+        calibration = {}
+        filepath = config['calibration'].get('file')
+        try:
+            with open(filepath) as f:
+                ob = json.load(f)
+        except FileNotFoundError:
+            return calibration
+        except (OSError, ValueError) as e:
+            log.warning(f'cannot read calibration: {filepath}: {e}')
+            return calibration
+
+        host = ob.get('hosts', {}).get(socket.gethostname(), {})
+        for result in host.get('results', []):
+            calibration[result['key']] = result
+    return calibration
+
+def get_profile_codec(id):
+    """The ffmpeg encoder to use for a profile.
+    """
+    profile = encoding_profiles[id]
+    ffargs = profile['ffargs']
+    if ffargs['codec'] != 'auto':
+        return ffargs['codec']
+
+    results = load_calibration()
+    min_psnr = profile['min_psnr']
+    best = None
+    for encoder in profile['encoders']:
+        result = results.get(get_calibration_key(encoder, ffargs['profile'], ffargs['pix_fmt']))
+        if not result:
+            continue
+        if min_psnr and (result['psnr'] is None or result['psnr'] < min_psnr):
+            # quality unknown (measuring failed) doesn't qualify
+            continue
+        if not best or result['fps'] > best['fps']:
+            best = result
+
+    if not best:
+        return profile['encoders'][0]
+    return best['encoder']
 
 
 framerates = {}
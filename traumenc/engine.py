@@ -4,30 +4,65 @@ import io
 import sys
 import time
 import json
+import queue
 import shlex
+import ctypes
+import signal
 import shutil
 import clique
 import pickle
 import hashlib
+import inspect
 import platform
+import tempfile
+import itertools
+import threading
 import subprocess
+import collections
 import multiprocessing
+import multiprocessing.connection
 from fractions import Fraction
 
+try:
+    # used for decoding still images without spawning ffmpeg
+    from PyQt5.QtCore import QSize, QBuffer, QByteArray, QIODevice
+    from PyQt5.QtGui import QImageReader
+except ImportError:
+    QImageReader = None
+
 import logging
-from utils import setup_logging
+from utils import setup_logging, stop_logging, SAMPLED
 log = logging.getLogger('engine.proxy')
 
 from config import config
-from encodingprofiles import encoding_profiles, framerates
+from encodingprofiles import encoding_profiles, framerates, get_profile_codec
+import profiling
+from profiling import span
+import history
+import preflight
+import governor
+import prefetch
+import publish
+import verify
+import control
+import fingerprint
+import encodecache
+import filmstrip
 
 
 # connection to client
 engine_conn = None
 
 def send_to_client(*args):
+    if control_server:
+        control_server.broadcast(*args)
     if engine_conn:
-        engine_conn.send(args)
+        if profiling.enabled:
+            t0 = time.perf_counter()
+            engine_conn.send(args)
+            profiling.record(f'ipc.send.{args[0]}', time.perf_counter() - t0)
+        else:
+            engine_conn.send(args)
 
 # the media database: all active media objects
 media_items = {}
@@ -44,6 +79,7 @@ media_item_template = {
     'codec': '',
     'pixfmt': '',
     'thumbnail': None,
+    'filmstrip': None,
     'progress': 0.0,
 }
 
@@ -65,10 +101,110 @@ def media_update(id, **kwargs):
     send_to_client('media_update', id, kwargs)
 
 def media_delete(id):
+    remove_duplicate_index(id)
     del media_items[id]
     send_to_client('media_delete', id)
 
 
+# duplicate sources, grouped under the first one found
+duplicate_groups = {}       # representative id -> ids, including itself
+identity_index = {}         # (st_dev, st_ino, frames) -> id
+size_index = {}             # (type, filesize) -> ids
+item_identities = {}        # id -> identity
+item_fingerprints = {}      # id -> content fingerprint, computed on demand
+
+def get_item_fingerprint(id):
+    fp = item_fingerprints.get(id)
+    if fp is None:
+        with span('dedupe.fingerprint'):
+            fp = fingerprint.get_item_fingerprint(media_lookup(id))
+        item_fingerprints[id] = fp
+    return fp
+
+def find_duplicate(id):
+    """Index an item, returning an existing item with the same content.
+    Only items of the same size are ever fingerprinted.
+    """
+    confirm = config['dedupe'].getboolean('confirm')
+    item = media_lookup(id)
+    identity = fingerprint.get_item_identity(item)
+    item_identities[id] = identity
+    other = identity_index.setdefault(identity, id)
+    if other != id:
+        # a hardlink
+        return other
+
+    sizekey = (item['type'], item.get('filesize', 0))
+    others = size_index.setdefault(sizekey, [])
+    match = None
+    if others:
+        fp = get_item_fingerprint(id)
+        # copied, comparing polls the client, which can remove items
+        for other in list(others):
+            if get_item_fingerprint(other) != fp:
+                continue
+            if confirm:
+                with span('dedupe.compare'):
+                    same = fingerprint.compare_items(item, media_lookup(other), should_stop_compare)
+                if not same or not media_lookup(other):
+                    continue
+            match = other
+            break
+    others.append(id)
+    return match
+
+def should_stop_compare():
+    # comparing whole sources takes a while, stay responsive
+    poll_client()
+    return scan_cancelled
+
+def add_duplicate_index(id):
+    if not config['dedupe'].getboolean('enabled'):
+        return
+
+    try:
+        match = find_duplicate(id)
+    except OSError as e:
+        log.warning(f'cannot fingerprint {id}: {e}')
+        return
+
+    if match is None:
+        duplicate_groups[id] = [id]
+        return
+
+    representative = media_lookup(match).get('duplicate_of') or match
+    duplicate_groups[representative].append(id)
+    media_update(id, duplicate_of=representative)
+    log.info('duplicate: %s of %s', media_lookup(id)['path'], media_lookup(representative)['path'])
+
+def remove_duplicate_index(id):
+    item = media_lookup(id)
+    identity = item_identities.pop(id, None)
+    if identity and identity_index.get(identity) == id:
+        del identity_index[identity]
+    item_fingerprints.pop(id, None)
+
+    sizekey = (item['type'], item.get('filesize', 0))
+    others = size_index.get(sizekey)
+    if others and id in others:
+        others.remove(id)
+
+    representative = item.get('duplicate_of') or id
+    group = duplicate_groups.pop(representative, None)
+    if not group:
+        return
+    group.remove(id)
+    if representative != id:
+        duplicate_groups[representative] = group
+    elif group:
+        # the next copy stands in for the group
+        representative = group[0]
+        duplicate_groups[representative] = group
+        media_update(representative, duplicate_of=None)
+        for other in group[1:]:
+            media_update(other, duplicate_of=representative)
+
+
 def media_lookup(id):
     return media_items.get(id)
 
@@ -81,11 +217,11 @@ def get_color_spec(item):
             -colorspace bt709
         '''
 
-def get_ff_input_spec(item, framerate=None, color_spec=True):
+def get_ff_input_spec(item, framerate=None, color_spec=True, start_frame=0):
     if item['type'] == 'sequence':
         seq = clique.parse(item['path'])
         seqpath = seq.format('{head}{padding}{tail}')
-        start = list(seq.indexes)[0]
+        start = list(seq.indexes)[start_frame]
         if not framerate:
             framerate = item['framerate']
         sequence_framerate = ':'.join(str(x) for x in framerate)
@@ -99,6 +235,9 @@ def get_ff_input_spec(item, framerate=None, color_spec=True):
     elif item['type'] == 'video':
         filepath = item['path']
         inputspec = f'-i "{filepath}"'
+        if start_frame:
+            num, den = item['framerate']
+            inputspec = f'-ss {start_frame * den / num:.6f} {inputspec}'
     return inputspec
 
 def calc_media_id(ob):
@@ -151,15 +290,26 @@ def subprocess_exec(cmd, encoding='utf8'):
 
     cmd = cmd.strip()
     args = shlex.split(cmd)
-    log.debug(f'exec: {" ".join(args)}')
-
-    kwargs = dict(capture_output=True, encoding=encoding)
-    if subprocess_creationflags:
-        kwargs['creationflags'] = subprocess_creationflags
-
-    proc = subprocess.run(args, **kwargs)
-    proc.check_returncode()
-    return proc.stdout
+    log.debug('exec: %s', ' '.join(args), extra=SAMPLED)
+
+    # waited on here rather than by subprocess.run(), for its own cpu
+    # time. stderr goes to a file so neither pipe can fill and block
+    with tempfile.TemporaryFile() as errfile:
+        proc = subprocess_popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=errfile)
+        with proc.stdout:
+            out = proc.stdout.read()
+        rc, cpu = wait_process(proc)
+        errfile.seek(0)
+        err = errfile.read()
+
+    if cpu is not None:
+        profiling.add_child_cpu(cpu)
+    if encoding:
+        out = out.decode(encoding)
+        err = err.decode(encoding, 'replace')
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, args, out, err)
+    return out
 
 def subprocess_popen(args, **kwargs):
     if subprocess_creationflags:
@@ -209,7 +359,7 @@ def cancel_scan():
     global scan_cancelled
     scan_cancelled = True
 
-def scan_paths(paths, sequence_framerate):
+def scan_paths(paths, sequence_framerate=(30, 1)):
     scan_in_progress = len(scan_paths_queue) > 0
     scan_paths_queue.extend(paths)
     if scan_in_progress:
@@ -252,9 +402,7 @@ def scan_paths(paths, sequence_framerate):
             # remove all queued paths
             scan_paths_queue.clear()
 
-    def add_file(filepath):
-        scan_update(0, 1)
-
+    def classify_file(filepath):
         _, ext = os.path.splitext(filepath)
         if not ext or ext[0] != '.':
             return
@@ -265,9 +413,19 @@ def scan_paths(paths, sequence_framerate):
         elif ext in image_exts:
             images.append(filepath)
 
+    def add_file(filepath):
+        scan_update(0, 1)
+
+        if profiling.enabled:
+            t0 = time.perf_counter()
+            classify_file(filepath)
+            profiling.record('scan.classify', time.perf_counter() - t0)
+        else:
+            classify_file(filepath)
+
     def add_dir(dirpath):
-        for dirpath, _, filenames in os.walk(path, followlinks=True):
-            log.debug(f'scan dir: {dirpath}')
+        for dirpath, _, filenames in profiling.timed_iter('scan.walk', os.walk(path, followlinks=True)):
+            log.debug('scan dir: %s', dirpath, extra=SAMPLED)
             scan_update(1, 0)
             for filename in filenames:
                 filepath = os.path.join(dirpath, filename)
@@ -297,32 +455,56 @@ def scan_paths(paths, sequence_framerate):
             ob['displayname'] = ob['filename']
 
         media_update(id, **ob)
+        return id
+
+    def add_items(type, paths):
+        # add, probe and thumbnail in batches, so the thumbnailer can
+        # share an ffmpeg process between items
+        batch_size = config['engine'].getint('thumbnail_batch_size')
+        for i in range(0, len(paths), batch_size):
+            if scan_cancelled:
+                return
 
-        #log.info(f'SCAN_CANCELLED={scan_cancelled}')
-        if not scan_cancelled:
-            if probe_item(id) and thumbnail_item(id):
-                media_update(id, state='ready')
-            else:
-                # broken... delete it
-                media_delete(id)
+            ids = [add_item(type, path) for path in paths[i:i+batch_size]]
+
+            #log.info(f'SCAN_CANCELLED={scan_cancelled}')
+            probed = []
+            for id in ids:
+                if scan_cancelled:
+                    return
+                if probe_item(id):
+                    probed.append(id)
+                else:
+                    # broken... delete it
+                    media_delete(id)
+                poll_client()
+
+            thumbnailed = thumbnail_items(probed)
+            for id in probed:
+                if id in thumbnailed:
+                    media_update(id, state='ready')
+                    add_duplicate_index(id)
+                elif not scan_cancelled:
+                    media_delete(id)
             poll_client()
 
     def add_videos_and_sequences():
         nonlocal videos
         nonlocal sequences
 
+        paths = []
         for path in videos:
             if matches_default_outpath(path):
-                log.info(f'scan ignoring: {path}')
+                log.info('scan ignoring: %s', path)
                 continue
-            add_item('video', path)
+            paths.append(path)
         videos = []
+        add_items('video', paths)
 
         # XXX framerate set on scan
-        for seq in sequences:
-            path = str(seq)
-            add_item('sequence', path)
+        paths = [str(seq) for seq in sequences]
         sequences = []
+        add_items('sequence', paths)
 
     def assemble_sequences():
         if images:
@@ -331,24 +513,27 @@ def scan_paths(paths, sequence_framerate):
 
             start_time = time.time()
             log.debug(f'assembling sequences from {len(images)} images...')
-            seqs, _ = clique.assemble(images, minimum_items=minimum_items)
-            if contiguous_only:
-                seqs = [s for s in seqs if s.is_contiguous()]
+            with span('scan.assemble', images=len(images)) as sp:
+                seqs, _ = clique.assemble(images, minimum_items=minimum_items)
+                if contiguous_only:
+                    seqs = [s for s in seqs if s.is_contiguous()]
+                sp.set(sequences=len(seqs))
             sequences.extend(seqs)
             elapsed = time.time() - start_time
             log.debug(f'assembling sequences done ({elapsed:.2f} seconds)')
 
-    # scan paths
-    while scan_paths_queue:
-        path = scan_paths_queue.pop(0)
-        if os.path.isfile(path):
-            add_file(path)
-        elif os.path.isdir(path):
-            add_dir(path)
-            assemble_sequences()
-
-    # add remaining videos and sequences
-    add_videos_and_sequences()
+    with span('scan_paths', paths=len(paths)):
+        # scan paths
+        while scan_paths_queue:
+            path = scan_paths_queue.pop(0)
+            if os.path.isfile(path):
+                add_file(path)
+            elif os.path.isdir(path):
+                add_dir(path)
+                assemble_sequences()
+
+        # add remaining videos and sequences
+        add_videos_and_sequences()
 
     # clean up and cancellation mess
     if scan_cancelled:
@@ -367,7 +552,13 @@ def scan_paths(paths, sequence_framerate):
     else:
         send_to_client('scan_complete')
 
+    profiling.report()
+
 def probe_item(id):
+    with span('probe_item', id=id):
+        return _probe_item(id)
+
+def _probe_item(id):
     item = media_lookup(id)
     program = get_ffmpeg_bin('ffprobe')
     inspec = get_ff_input_spec(item, color_spec=False)
@@ -377,6 +568,7 @@ def probe_item(id):
             {program}
                 -v 0
                 -show_streams
+                -show_entries format=duration
                 -print_format json
                 {inspec}
             ''')
@@ -394,7 +586,8 @@ def probe_item(id):
             st.get('height', 0))
 
         pixfmt = st.get('pix_fmt', 'unknown')
-        duration = st.get('duration', 0.0)
+        # matroska and webm only have it on the format
+        duration = st.get('duration') or ob.get('format', {}).get('duration') or 0.0
 
         media_update(id,
             codec=st['codec_name'],
@@ -424,6 +617,10 @@ def probe_item(id):
 
 
 def thumbnail_item(id, size=(-1, 256)):
+    with span('thumbnail_item', id=id):
+        return _thumbnail_item(id, size)
+
+def _thumbnail_item(id, size):
     item = media_lookup(id)
     inspec = get_ff_input_spec(item)
     outpath = '-'   # stdout
@@ -454,18 +651,231 @@ def thumbnail_item(id, size=(-1, 256)):
         return False
 
 
-def remove_items(ids):
-    # XXX some things that should happen here..
-    # is the item in the encode queue?
+def thumbnail_items(ids, size=(-1, 256)):
+    """Thumbnail items, several per ffmpeg process. Falls back to one
+    process per item if a batch fails. Returns the ids that succeeded.
+    """
+    done = set()
+
+    # still image sequences can be decoded in-process
+    for id in ids:
+        if can_thumbnail_natively(media_lookup(id)) and thumbnail_item_native(id, size):
+            done.add(id)
+    ids = [id for id in ids if id not in done]
+
+    batch_size = config['engine'].getint('thumbnail_batch_size')
+    for i in range(0, len(ids), batch_size):
+        if scan_cancelled:
+            break
+
+        batch = ids[i:i+batch_size]
+        if len(batch) > 1:
+            done.update(thumbnail_batch(batch, size))
+
+        for id in batch:
+            if id not in done and thumbnail_item(id, size):
+                done.add(id)
+        poll_client()
+    return done
+
+native_thumbnail_exts = {'png', 'jpg', 'jpeg', 'tif', 'tiff'}
+
+def can_thumbnail_natively(item):
+    if not QImageReader or not config['engine'].getboolean('native_thumbnails'):
+        return False
+    if item['type'] != 'sequence':
+        return False
+    seq = clique.parse(item['path'])
+    ext = seq.tail.rsplit('.', 1)[-1].lower()
+    return ext in native_thumbnail_exts
+
+def thumbnail_item_native(id, size=(-1, 256)):
+    with span('thumbnail_item_native', id=id):
+        return _thumbnail_item_native(id, size)
+
+def _thumbnail_item_native(id, size):
+    item = media_lookup(id)
+    seq = clique.parse(item['path'])
+    filepath = next(iter(seq))
+
+    # match ffmpeg's scale=-1:256, letting the reader decode at reduced
+    # resolution where the format supports it
+    reader = QImageReader(filepath)
+    full = reader.size()
+    if not full.isValid() or not full.height():
+        return False
+    width, height = size
+    if width < 0:
+        width = max(1, round(full.width() * height / full.height()))
+    reader.setScaledSize(QSize(width, height))
+
+    image = reader.read()
+    if image.isNull():
+        log.warn(f'native thumbnail failed: {filepath}: {reader.errorString()}')
+        return False
+
+    data = QByteArray()
+    buf = QBuffer(data)
+    buf.open(QIODevice.WriteOnly)
+    image.save(buf, 'JPG', 90)
+    media_update(id, thumbnail=bytes(data))
+    return True
 
+def thumbnail_batch(ids, size):
+    with span('thumbnail_batch', items=len(ids)):
+        return _thumbnail_batch(ids, size)
+
+def _thumbnail_batch(ids, size):
+    program = get_ffmpeg_bin('ffmpeg')
+
+    with tempfile.TemporaryDirectory(prefix='traumenc-thumbs-') as tempdir:
+        # same options as thumbnail_item(), with each input mapped to
+        # its own output
+        inspecs = []
+        outspecs = []
+        for n, id in enumerate(ids):
+            item = media_lookup(id)
+            inspecs.append(f'-ss 0 -noaccurate_seek {get_ff_input_spec(item)}')
+            outpath = os.path.join(tempdir, f'{n}.jpg')
+            outspecs.append(f'-map {n}:v:0 -frames 1 -vf scale={size[0]}:{size[1]} -f singlejpeg -y "{outpath}"')
+
+        inspecs = '\n'.join(inspecs)
+        outspecs = '\n'.join(outspecs)
+        cmd = f'''
+            {program}
+                -v 0
+                {inspecs}
+                {outspecs}
+        '''
+
+        try:
+            subprocess_exec(cmd, encoding=None)
+        except subprocess.CalledProcessError as e:
+            log.warn(f'thumbnail batch of {len(ids)} failed, retrying individually')
+            log.warn(e.cmd)
+            return []
+
+        done = []
+        for n, id in enumerate(ids):
+            outpath = os.path.join(tempdir, f'{n}.jpg')
+            if not os.path.isfile(outpath):
+                continue
+            with open(outpath, 'rb') as f:
+                media_update(id, thumbnail=f.read())
+            done.append(id)
+        return done
+
+
+def filmstrip_items(ids):
+    """Send a filmstrip of each item, from the cache or made now. One
+    that can't be made is sent as None, so it can be asked for again.
+    """
+    if not filmstrip.is_enabled():
+        return
+
+    frames = filmstrip.get_frame_count()
+    height = config['filmstrip'].getint('height')
+    for id in ids:
+        item = media_lookup(id)
+        if not item:
+            continue
+        if item['state'] == 'new':
+            media_update(id, filmstrip=None)
+            continue
+
+        try:
+            key = filmstrip.get_key(item, frames, height)
+        except OSError as e:
+            log.warn(f'filmstrip: cannot stat {id}: {e}')
+            media_update(id, filmstrip=None)
+            continue
+
+        # short sequences have fewer frames than asked for
+        sources = filmstrip.get_sources(item, frames)
+        data = filmstrip.load(key)
+        if not data:
+            data = filmstrip_item(id, sources, height)
+            if not data:
+                media_update(id, filmstrip=None)
+                continue
+            filmstrip.store(key, data)
+
+        media_update(id, filmstrip=data, filmstrip_frames=len(sources))
+        poll_client()
+
+def filmstrip_item(id, sources, height):
+    with span('filmstrip_item', id=id):
+        return _filmstrip_item(id, sources, height)
+
+def _filmstrip_item(id, sources, height):
+    item = media_lookup(id)
+
+    # one input per frame, so only those frames are read
+    inspecs = []
+    if item['type'] == 'sequence':
+        color_spec = get_color_spec(item) or ''
+        for filepath in sources:
+            inspecs.append(f'{color_spec} -i "{filepath}"')
+    else:
+        filepath = item['path']
+        for t in sources:
+            # from the keyframe before, decoding nothing else
+            inspecs.append(f'-skip_frame nokey -ss {t:.3f} -noaccurate_seek -i "{filepath}"')
+
+    # first frame of each, tiled left to right
+    n = len(inspecs)
+    scaled = ';'.join(f'[{i}:v]trim=end_frame=1,scale=-2:{height},setsar=1[f{i}]' for i in range(n))
+    labels = ''.join(f'[f{i}]' for i in range(n))
+    graph = f'{scaled};{labels}concat=n={n}:v=1:a=0,tile={n}x1'
+
+    inspecs = '\n'.join(inspecs)
+    program = get_ffmpeg_bin('ffmpeg')
+    cmd = f'''
+        {program}
+            -v 0
+            {inspecs}
+            -filter_complex "{graph}"
+            -frames:v 1
+            -f singlejpeg
+            -y
+            -
+    '''
+
+    try:
+        return subprocess_exec(cmd, encoding=None)
+    except subprocess.CalledProcessError as e:
+        log.warn(f'filmstrip failed: {id}')
+        log.warn(e.cmd)
+        return None
+
+
+def remove_items(ids):
+    removed = set()
     for id in ids:
         item = media_lookup(id)
+        if not item:
+            # already gone
+            continue
         state = item['state']
-        if state in ('new', 'encoding'):
+        if state in ('new', 'encoding', 'paused'):
             # ignore
             continue
 
         media_delete(id)
+        removed.add(id)
+
+    # drop any that were waiting in the encode queue, a removed
+    # representative hands its job on to the first copy left
+    for job in encode_queue + encode_running:
+        job.copies = [id for id in job.copies if id not in removed]
+    for job in list(encode_queue):
+        if job.id not in removed:
+            continue
+        if job.copies:
+            job.id = job.copies.pop(0)
+            job.outpath = None
+        else:
+            encode_queue.remove(job)
 
 
 def preview_item(id, framerate=None):
@@ -492,70 +902,445 @@ def preview_item(id, framerate=None):
 
 
 encode_cancelled = False
+encode_in_progress = False
+
+# jobs waiting to start, jobs with a process (running or suspended),
+# finished jobs being moved from scratch to their destination, and
+# published jobs being verified
+encode_queue = []
+encode_running = []
+encode_publishing = []
+encode_verifying = []
+
+# verification manifests of the batches in this run
+encode_manifests = []
+
+# (job, event, value) from the stderr reader and transfer threads
+encode_events = queue.Queue()
+
+encode_job_counter = itertools.count()
 
 def cancel_encode():
     log.debug('cancel_encode')
     global encode_cancelled
     encode_cancelled = True
 
-def encode_items(ids, profile, framerate, timecode, burn_in):
+def encode_items(ids, profile='prores_422', framerate=None, timecode=None, burn_in=None, priority=0):
     global encode_cancelled
     if encode_cancelled:
         # don't add more to the queue on re-entry
         return
 
-    encode_queue = []
-
     if not ids:
         # no selection provided: add anything that's ready
         ids = [id for id in media_items.keys() if media_lookup(id)['state'] == 'ready']
 
+    if not preflight_encode(ids, profile):
+        return
+
+    manifest = None
+    if verify.is_enabled():
+        manifest = verify.Manifest(profile)
+        encode_manifests.append(manifest)
+
+    # copies of the same source get the output of a single encode
+    jobs = {}
     for id in ids:
-        media_update(id, state='queued')
-        encode_queue.append((id, profile, framerate, timecode, burn_in))
+        media_update(id, state='queued', priority=priority)
+        key = media_lookup(id).get('duplicate_of') or id
+        job = jobs.get(key)
+        if job:
+            job.copies.append(id)
+            continue
 
-    while encode_queue:
-        if encode_cancelled:
-            break
+        job = jobs[key] = EncodeJob(id, profile, framerate, timecode, burn_in, priority)
+        job.manifest = manifest
+        encode_queue.append(job)
 
-        id, profile, framerate, timecode, burn_in = encode_queue.pop(0)
-        encode_item(id, profile, framerate, timecode, burn_in)
+    if encode_in_progress:
+        # called from a poll_client(), the running queue picks them up
+        return
 
-    if encode_cancelled:
-        # queue -> ready
-        for id, profile, framerate, timecode, burn_in in encode_queue:
-            media_update(id, state='ready')
+    run_encode_batch('encode_complete')
+
+def run_encode_batch(*complete):
+    global encode_cancelled
+    run_encode_queue()
 
+    for manifest in encode_manifests:
+        manifest.write()
+    encode_manifests.clear()
+
+    if encode_cancelled:
         send_to_client('encode_cancelled')
         encode_cancelled = False    # reset
     else:
-        send_to_client('encode_complete')
+        send_to_client(*complete)
 
+    profiling.report()
 
-def encode_item(id, profile, framerate=None, timecode=None, burn_in=None, outpath=None):
-    item = media_lookup(id)
-    if not item:
-        log.warn(f'encode_item: can\'t find item {id}')
+
+def encode_samples(ids, profile='prores_422', framerate=None, timecode=None, burn_in=None):
+    """Encode a short window of each ready item into a temporary folder,
+    to check the settings before committing to the whole batch.
+    """
+    if encode_cancelled:
+        return
+
+    if not ids:
+        ids = [id for id in media_items.keys() if media_lookup(id)['state'] == 'ready']
+
+    jobs = {}   # filename -> job
+    for id in ids:
+        item = media_lookup(id)
+        if not item or item['state'] != 'ready':
+            continue
+
+        sample = get_sample_window(item)
+        if not sample:
+            log.warning(f'encode_samples: no frames to sample in {id}')
+            continue
+
+        # sources in different folders can share a name
+        filename = os.path.basename(get_item_default_outpath(item))
+        if filename in jobs:
+            filename = f'{id}_{filename}'
+
+        job = EncodeJob(id, profile, framerate, timecode, burn_in)
+        job.sample = sample
+        jobs[filename] = job
+
+    if not jobs:
+        log.warning('encode_samples: nothing to sample')
+        if not encode_in_progress:
+            send_to_client('sample_complete', None)
         return
 
-    if outpath is None:
-        outpath = get_item_default_outpath(item)
+    dirpath = config['sample'].get('dir')
+    if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
+    else:
+        dirpath = tempfile.mkdtemp(prefix='traumenc-samples-')
+
+    for filename, job in jobs.items():
+        job.outpath = os.path.join(dirpath, filename)
+        media_update(job.id, state='queued')
+        encode_queue.append(job)
+
+    log.info(f'encode_samples: {dirpath}')
+    if encode_in_progress:
+        return
+
+    run_encode_batch('sample_complete', dirpath)
+
+def get_sample_window(item):
+    """The (first frame, frame count) of an item to encode as a sample.
+    """
+    cfg = config['sample']
+    total = preflight.get_item_frame_count(item)
+    if not total and item['type'] == 'video':
+        # no duration to go by, take them from the start
+        return (0, cfg.getint('frames'))
+    frames = min(cfg.getint('frames'), total)
+    if cfg.get('position') == 'middle':
+        return ((total - frames) // 2, frames) if frames else None
+    return (0, frames) if frames else None
+
+def preflight_encode(ids, profile):
+    jobs = []
+    for id in ids:
+        item = media_lookup(id)
+        if item:
+            jobs.append((item, get_item_default_outpath(item)))
+
+    with span('preflight', items=len(jobs)):
+        ok, estimate, problems = preflight.run_preflight(jobs, profile)
+
+    if estimate:
+        send_to_client('encode_estimate', estimate, problems)
+    if not ok:
+        send_to_client('encode_refused', problems)
+    return ok
+
+
+class EncodeJob(object):
+    """An encode of one item, from the queue through to its ffmpeg
+    process finishing.
+    """
+    def __init__(self, id, profile, framerate=None, timecode=None, burn_in=None, priority=0, outpath=None):
+        self.id = id
+        self.profile = profile
+        self.framerate = framerate
+        self.timecode = timecode
+        self.burn_in = burn_in
+        self.priority = priority
+        self.outpath = outpath
+        self.encode_path = None
+        self.order = next(encode_job_counter)
+
+        self.proc = None
+        self.span_t0 = None     # perf_counter() when the process started
+        self.devices = None
+        self.prefetcher = None
+        self.manifest = None
+        self.copies = []        # duplicate items sharing this encode
+        self.copy_of = None     # the job whose output this is a copy of
+        self.cache_key = None
+        self.cache_hit = False
+        self.sample = None      # (first frame, frames) for a sample encode
+        self.suspended = False  # process stopped
+        self.held = False       # paused by the client, not the scheduler
+
+        self.start_time = 0.0
+        self.suspend_time = 0.0
+        self.suspended_secs = 0.0   # not counted in wall_time
+        self.wall_time = 0.0
+        self.duration_secs = 0.0
+        self.progress_secs = 0.0
+        self.progress_frames = 0
+        self.output = collections.deque(maxlen=100)
+
+    def sort_key(self):
+        # highest priority first, then first come first served
+        return (-self.priority, self.order)
+
+
+def find_encode_jobs(ids):
+    ids = set(ids)
+    return [job for job in encode_queue + encode_running if job.id in ids]
+
+def pause_encode(ids):
+    for job in find_encode_jobs(ids):
+        job.held = True
+        if job.proc and not job.suspended:
+            suspend_encode_job(job)
+        media_update(job.id, state='paused')
+
+def resume_encode(ids):
+    # the scheduler restarts them when there's a free slot
+    for job in find_encode_jobs(ids):
+        job.held = False
+        if not job.proc:
+            media_update(job.id, state='queued')
+
+def set_encode_priority(ids, priority):
+    for job in find_encode_jobs(ids):
+        job.priority = priority
+        media_update(job.id, priority=priority)
+
+
+def run_encode_queue():
+    global encode_in_progress
+    encode_in_progress = True
+
+    try:
+        while encode_queue or encode_running or encode_publishing or encode_verifying:
+            if encode_cancelled:
+                for job in encode_running:
+                    log.warn(f'encode cancelled: killing proc {job.proc.pid}')
+                    job.proc.kill()
+
+                # queue -> ready
+                for job in encode_queue:
+                    media_update(job.id, state='ready')
+                    update_copies(job, state='ready')
+                encode_queue.clear()
+
+                # wait for the killed jobs to finish up, and let
+                # finished ones get published and verified
+                while encode_running or encode_publishing or encode_verifying:
+                    handle_encode_events(timeout=0.1)
+                break
+
+            schedule_encode_jobs()
+            handle_encode_events(timeout=0.1)
+            poll_client()
+    finally:
+        encode_in_progress = False
+
+def get_max_encode_jobs(active):
+    if governor.is_enabled():
+        # fewer than are running just stops new jobs starting
+        pids = [job.proc.pid for job in active]
+        waiting = sum(1 for job in encode_queue if not job.held)
+        return governor.get_governor().update(pids, waiting)
+    return config['engine'].getint('max_jobs')
+
+def get_job_devices(job):
+    """The devices (st_dev) a job reads from and writes to.
+    """
+    if job.devices is None:
+        devices = set()
+        item = media_lookup(job.id)
+        if item:
+            outpath = job.outpath or get_item_default_outpath(item)
+            for path in (item['path'], outpath):
+                try:
+                    devices.add(os.stat(os.path.dirname(path)).st_dev)
+                except OSError:
+                    pass
+        job.devices = tuple(sorted(devices))
+    return job.devices
+
+def schedule_encode_jobs():
+    """Start, resume or preempt jobs to keep the most urgent ones
+    running, up to the maximum number of concurrent jobs and jobs per
+    device. Jobs of the same priority are spread across devices.
+    """
+    active = [job for job in encode_running if not job.suspended]
+    max_jobs = get_max_encode_jobs(active)
+    # samples are short, run plenty of them at once
+    max_sample_jobs = max(max_jobs, config['sample'].getint('max_jobs') or os.cpu_count())
+    max_device_jobs = config['engine'].getint('max_jobs_per_device')
+
+    device_jobs = collections.Counter()
+    for job in active:
+        device_jobs.update(get_job_devices(job))
+
+    def get_blocked_devices(job):
+        if not max_device_jobs:
+            return set()
+        return {dev for dev in get_job_devices(job) if device_jobs[dev] >= max_device_jobs}
+
+    # preempted jobs compete with queued jobs for a slot
+    candidates = [job for job in encode_queue + encode_running
+                  if job.suspended or not job.proc]
+    candidates = [job for job in candidates if not job.held]
+    candidates.sort(key=EncodeJob.sort_key)
+
+    # one queue per set of devices, most urgent first
+    groups = {}
+    for job in candidates:
+        groups.setdefault(get_job_devices(job), []).append(job)
+
+    def placement_key(devices):
+        job = groups[devices][0]
+        busy = max((device_jobs[dev] for dev in devices), default=0)
+        return (-job.priority, busy, job.order)
+
+    while groups:
+        devices = min(groups, key=placement_key)
+        job = groups[devices].pop(0)
+        if not groups[devices]:
+            del groups[devices]
+
+        blocked = get_blocked_devices(job)
+        if blocked or len(active) >= (max_sample_jobs if job.sample else max_jobs):
+            # suspend the least urgent running job if this one outranks
+            # it, it has to be using the devices this one is waiting on
+            victims = [other for other in active if blocked <= set(get_job_devices(other))]
+            lowest = max(victims, key=EncodeJob.sort_key) if victims else None
+            if not lowest or job.priority <= lowest.priority:
+                if not blocked:
+                    # nothing else outranks it either, but samples
+                    # behind it have a higher limit
+                    continue
+                # the rest of the group is waiting on the same devices
+                groups.pop(devices, None)
+                continue
+
+            log.info(f'preempting {lowest.id} (priority {lowest.priority}) for {job.id} (priority {job.priority})')
+            suspend_encode_job(lowest)
+            media_update(lowest.id, state='paused')
+            active.remove(lowest)
+            device_jobs.subtract(get_job_devices(lowest))
+
+        if job.suspended:
+            resume_encode_job(job)
+            media_update(job.id, state='encoding')
+        else:
+            encode_queue.remove(job)
+            if not start_encode_job(job):
+                continue
+        active.append(job)
+        device_jobs.update(get_job_devices(job))
+
+def suspend_process(proc):
+    if platform.system() == 'Windows':
+        handle = ctypes.windll.kernel32.OpenProcess(PROCESS_SUSPEND_RESUME, False, proc.pid)
+        ctypes.windll.ntdll.NtSuspendProcess(handle)
+        ctypes.windll.kernel32.CloseHandle(handle)
+    else:
+        os.kill(proc.pid, signal.SIGSTOP)
+
+def resume_process(proc):
+    if platform.system() == 'Windows':
+        handle = ctypes.windll.kernel32.OpenProcess(PROCESS_SUSPEND_RESUME, False, proc.pid)
+        ctypes.windll.ntdll.NtResumeProcess(handle)
+        ctypes.windll.kernel32.CloseHandle(handle)
+    else:
+        os.kill(proc.pid, signal.SIGCONT)
+
+PROCESS_SUSPEND_RESUME = 0x0800
+
+def suspend_encode_job(job):
+    log.info('suspending encode %s (pid %d)', job.id, job.proc.pid)
+    suspend_process(job.proc)
+    job.suspended = True
+    job.suspend_time = time.time()
+
+def resume_encode_job(job):
+    log.info('resuming encode %s (pid %d)', job.id, job.proc.pid)
+    resume_process(job.proc)
+    job.suspended = False
+    job.suspended_secs += time.time() - job.suspend_time
+
+def wait_process(proc):
+    """Wait for a process, returning (returncode, cpu seconds). The cpu
+    time is only available where os.wait4() is.
+    """
+    if not hasattr(os, 'wait4'):
+        return proc.wait(), None
+
+    _, status, ru = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        rc = -os.WTERMSIG(status)
+    else:
+        rc = os.WEXITSTATUS(status)
+    proc.returncode = rc
+    return rc, ru.ru_utime + ru.ru_stime
+
+
+def encode_item(id, profile, framerate=None, timecode=None, burn_in=None, outpath=None):
+    """Encode a single item, waiting for it to finish. Called while
+    encodes are running (from a poll_client()), it's queued with them
+    and returns straight away.
+    """
+    job = EncodeJob(id, profile, framerate, timecode, burn_in, outpath=outpath)
+    encode_queue.append(job)
+    if not encode_in_progress:
+        run_encode_queue()
+
+def get_encode_args(job, item):
+    outpath = job.encode_path
+    framerate = job.framerate
+    timecode = job.timecode
 
     if framerate:
         framerate = framerates[framerate]['rate']
 
-    inspec = get_ff_input_spec(item, framerate)
+    sample_args = ''
+    if job.sample:
+        start_frame, frames = job.sample
+        inspec = get_ff_input_spec(item, framerate, start_frame=start_frame)
+        sample_args = f'-frames:v {frames}'
+        if item['type'] == 'video' and item['framerate'][0]:
+            # stop the audio there too
+            num, den = item['framerate']
+            sample_args += f' -t {frames * den / num:.6f}'
+    else:
+        inspec = get_ff_input_spec(item, framerate)
 
     # TODO force input framerate??
 
-    ffargs = encoding_profiles[profile]['ffargs']
+    ffargs = encoding_profiles[job.profile]['ffargs']
 
     timecode_args = []
     if timecode:
         timecode_args.append(
             f'-timecode {timecode}')
 
-    if burn_in:
+    if job.burn_in:
         if timecode:
             burn_in_timecode = timecode.replace(':', r'\:')
         else:
@@ -567,11 +1352,16 @@ def encode_item(id, profile, framerate=None, timecode=None, burn_in=None, outpat
 
     timecode_args = ' '.join(timecode_args)
 
+    thread_args = ''
+    if governor.is_enabled():
+        thread_args = f'-threads {governor.get_governor().get_threads()}'
+
     codec_args = f'''
-        -codec:v {ffargs['codec']}
+        -codec:v {get_profile_codec(job.profile)}
         -profile:v {ffargs['profile']}
         -vendor {ffargs['vendor']}
         -pix_fmt {ffargs['pix_fmt']}
+        {thread_args}
         {timecode_args}
     '''
 
@@ -585,103 +1375,369 @@ def encode_item(id, profile, framerate=None, timecode=None, burn_in=None, outpat
             {inspec}
             {codec_args}
             {audio_args}
+            {sample_args}
             -y "{outpath}"
     '''
+    return shlex.split(cmd)
 
-    # encode watcher
-    re_duration = re.compile(r'Duration: (\d{2}):(\d{2}):(\d{2}).(\d{2})')
-    re_progress = re.compile(r'time=(\d{2}):(\d{2}):(\d{2}).(\d{2})')
-    re_source = re.compile(r"from '(.*)':")
-    re_framerate = re.compile(r'(\d{2}.\d{2}|\d{2}) fps')
-    re_time = re.compile(r'(\d{2}.\d{2}|\d{2}) fps')
-
-    def get_time_from_match(m):
-        bits = [float(x) for x in m.groups()]
-        #print('BITS:', bits)
-        secs = 3600.0*bits[0] + 60.0*bits[1] + 1.0*bits[2] + 0.01*bits[3]
-        return secs
-
-    duration_secs = 0.0
-    progress_secs = 0.0
-    progress_percent = 0
-    #progress_bar = tqdm(total=100)
-
-    line = []
-    output = []
-    def on_stderr(ch):
-        nonlocal line
-        nonlocal duration_secs
-        nonlocal progress_secs
-        nonlocal progress_percent
-
-        if ch in '\r\n':
-            line = ''.join(line).strip()
-            output.append(line)
-            #print(line)
-
-            m = re_duration.search(line)
-            if m:
-                #print('duration:', m.group(0), get_time_from_match(m))
-                duration_secs = get_time_from_match(m)
-
-            m = re_source.search(line)
-            if m:
-                #print('source:', m.group(1))
-                pass
-
-            m = re_framerate.search(line)
-            if m:
-                #print('framerate:', float(m.group(1)))
-                pass
-
-            m = re_progress.search(line)
-            if m:
-                #print('progress:', m.group(0), get_time_from_match(m))
-                progress_secs = get_time_from_match(m)
-                if duration_secs > 0.0:
-                    progress = progress_secs / duration_secs
-                    progress_percent = round(100.0 * progress)
-                    log.debug(f'encode_item: {id} {progress_percent}%')
-                    media_update(id, progress=progress)
-
-                    # poll client here too...
-                    poll_client()
-
-            line = []
-        line.append(ch)
+def start_encode_job(job):
+    item = media_lookup(job.id)
+    if not item:
+        log.warn(f'encode_item: can\'t find item {job.id}')
+        return False
 
-    args = shlex.split(cmd)
-    log.info(f'encode_item: {id} {" ".join(args)}')
+    if job.outpath is None:
+        job.outpath = get_item_default_outpath(item)
+
+    if job.sample:
+        # already somewhere temporary, and never cached
+        job.encode_path = job.outpath
+    else:
+        job.encode_path = publish.get_scratch_path(job.id, job.outpath)
+
+    if encodecache.is_enabled() and not job.sample and fetch_cached_output(job, item):
+        # no process, doesn't take a slot
+        return False
+
+    args = get_encode_args(job, item)
+    log.info('encode_item: %s %s', job.id, ' '.join(args))
 
     # start the encoding process
-    media_update(id, state='encoding')
-    proc = subprocess_popen(args, bufsize=0, stderr=subprocess.PIPE)
-    t0 = time.time()
+    media_update(job.id, state='encoding')
+    job.span_t0 = time.perf_counter()
+
+    if item['type'] == 'sequence' and prefetch.is_enabled():
+        # start reading ahead before ffmpeg gets going
+        filepaths = list(clique.parse(item['path']))
+        if job.sample:
+            start_frame, frames = job.sample
+            filepaths = filepaths[start_frame:start_frame + frames]
+        job.prefetcher = prefetch.SequencePrefetcher(filepaths)
+        job.prefetcher.advance(0)
+
+    if job.sample:
+        # progress is through the sample, not the whole input
+        rate = framerates[job.framerate]['rate'] if job.framerate and item['type'] == 'sequence' else item['framerate']
+        if rate[0]:
+            job.duration_secs = job.sample[1] * rate[1] / rate[0]
+
+    job.proc = subprocess_popen(args, bufsize=0, stdin=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    job.start_time = time.time()
+    encode_running.append(job)
+
+    reader = threading.Thread(target=read_encode_output, args=(job,), daemon=True)
+    reader.start()
+    return True
+
+def get_encode_cache_key(job, item):
+    # everything that changes the output bits
+    ffargs = dict(encoding_profiles[job.profile]['ffargs'])
+    ffargs['codec'] = get_profile_codec(job.profile)
+    settings = {
+        'ffargs': ffargs,
+        'framerate': framerates[job.framerate]['rate'] if job.framerate else None,
+        'timecode': job.timecode,
+        'burn_in': bool(job.burn_in),
+        }
+    with span('cache.fingerprint'):
+        fp = fingerprint.get_item_fingerprint(item, all_sizes=True,
+                                              mtimes=config['cache'].getboolean('match_mtime'))
+    return encodecache.get_key(fp, settings)
+
+def fetch_cached_output(job, item):
+    if job.cache_key is None:
+        try:
+            job.cache_key = get_encode_cache_key(job, item)
+        except OSError as e:
+            log.warning(f'cannot fingerprint {job.id}: {e}')
+            return False
+
+    if job.cache_hit:
+        # fetching failed before, encode it
+        return False
+    cachepath = encodecache.lookup(job.cache_key)
+    if not cachepath:
+        return False
+
+    job.cache_hit = True
+    media_update(job.id, state='encoding')
+    encode_publishing.append(job)
+    publish.run_transfer_async(encodecache.fetch_output, cachepath, job.outpath,
+        lambda error: encode_events.put((job, 'published', error)))
+    return True
+
+def read_encode_output(job):
+    # reader thread: split stderr into lines, ffmpeg ends its
+    # progress lines with \r
+    pending = b''
     while True:
-        ch = proc.stderr.read(1)
-        if not ch:
+        data = job.proc.stderr.read(4096)
+        if not data:
             break
+        lines = re.split(b'[\r\n]', pending + data)
+        pending = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if line:
+                encode_events.put((job, 'output', str(line, encoding='utf8', errors='replace')))
+
+    if pending.strip():
+        encode_events.put((job, 'output', str(pending.strip(), encoding='utf8', errors='replace')))
+    encode_events.put((job, 'exit', None))
+
+def handle_encode_events(timeout):
+    try:
+        job, event, value = encode_events.get(timeout=timeout)
+    except queue.Empty:
+        return
 
-        if encode_cancelled:
-            break
+    while True:
+        if event == 'output':
+            on_encode_output(job, value)
+        elif event == 'exit':
+            finish_encode_job(job)
+        elif event == 'published':
+            finish_publish(job, value)
+        elif event == 'verified':
+            finish_verify(job, value)
 
-        ch = str(ch, encoding='utf8')
-        on_stderr(ch)
-        dt = time.time() - t0
+        try:
+            job, event, value = encode_events.get_nowait()
+        except queue.Empty:
+            break
 
-    if encode_cancelled:
-        log.warn(f'encode cancelled: killing proc {proc.pid}')
-        proc.kill()
+# encode watcher
+re_duration = re.compile(r'Duration: (\d{2}):(\d{2}):(\d{2}).(\d{2})')
+re_progress = re.compile(r'time=(\d{2}):(\d{2}):(\d{2}).(\d{2})')
+re_frame = re.compile(r'frame=\s*(\d+)')
+
+def get_time_from_match(m):
+    bits = [float(x) for x in m.groups()]
+    secs = 3600.0*bits[0] + 60.0*bits[1] + 1.0*bits[2] + 0.01*bits[3]
+    return secs
+
+def on_encode_output(job, line):
+    job.output.append(line)
+
+    m = re_duration.search(line)
+    if m and not job.sample:
+        job.duration_secs = get_time_from_match(m)
+
+    m = re_frame.search(line)
+    if m:
+        job.progress_frames = int(m.group(1))
+        if job.prefetcher:
+            job.prefetcher.advance(job.progress_frames)
+
+    m = re_progress.search(line)
+    if m:
+        job.progress_secs = get_time_from_match(m)
+        if job.duration_secs > 0.0:
+            progress = job.progress_secs / job.duration_secs
+            progress_percent = round(100.0 * progress)
+            log.debug('encode_item: %s %d%%', job.id, progress_percent, extra=SAMPLED)
+            media_update(job.id, progress=progress)
+
+def finish_encode_job(job):
+    rc, cpu = wait_process(job.proc)
+    encode_running.remove(job)
+
+    if job.prefetcher:
+        job.prefetcher.stop()
+
+    # the process's own cpu time, other encodes finish while it runs
+    args = dict(id=job.id, profile=job.profile, rc=rc)
+    if cpu is not None:
+        args['child_cpu'] = round(cpu, 6)
+    profiling.add_span('encode_item', job.span_t0, **args)
+
+    if job.suspended:
+        # killed while stopped
+        job.suspended_secs += time.time() - job.suspend_time
+    job.wall_time = time.time() - job.start_time - job.suspended_secs
+
+    if rc != 0 and (job.encode_path != job.outpath or job.sample):
+        # don't leave a truncated file for anything downstream, but
+        # never remove an output this job didn't write
+        publish.remove_partial(job.encode_path)
+
+    id = job.id
+    item = media_lookup(id)
+    if not item:
+        # removed while encoding
+        if rc == 0 and job.encode_path != job.outpath:
+            publish.remove_partial(job.encode_path)
+        update_copies(job, state='ready')
+        return
 
-    rc = proc.wait()
     if rc == 0:
-        media_update(id, progress=1.0, state='done', outpath=outpath)
+        if job.sample:
+            # nothing downstream, the item's still to be encoded
+            log.info('sample encoded: %s', job.outpath)
+            media_update(id, progress=0.0, state='ready', sample_path=job.outpath)
+        elif job.encode_path != job.outpath:
+            # the slot is free for the next encode while this moves
+            media_update(id, progress=1.0)
+            encode_publishing.append(job)
+            publish.publish_output_async(job.encode_path, job.outpath,
+                lambda error: encode_events.put((job, 'published', error)))
+        else:
+            verify_encode_job(job, item)
     elif encode_cancelled:
         media_update(id, progress=0.0, state='ready')
+        update_copies(job, state='ready')
     else:
         log.error(f'bad returncode: {rc}')
-        log.error('\n'.join(output)) # last line
-        media_update(id, progress=0.0, state='error')
+        log.error('\n'.join(job.output)) # last lines
+        if job.sample:
+            # says nothing about the item's own encode
+            media_update(id, progress=0.0, state='ready', sample_path=None)
+        else:
+            media_update(id, progress=0.0, state='error')
+            update_copies(job, state='error')
+
+def finish_publish(job, error):
+    encode_publishing.remove(job)
+    item = media_lookup(job.id)
+    if not item:
+        return
+
+    if error and job.cache_hit and not encode_cancelled:
+        # encode it after all
+        media_update(job.id, state='queued')
+        encode_queue.append(job)
+    elif error:
+        media_update(job.id, progress=0.0, state='error')
+        update_copies(job, state='error')
+    else:
+        # cache hits and copies too, a cached output is only as good as
+        # its key and a copy as the transfer
+        verify_encode_job(job, item)
+
+def probe_output(outpath, count_frames=False):
+    program = get_ffmpeg_bin('ffprobe')
+    if count_frames:
+        count_args = '-count_packets -count_frames'
+        entries = 'nb_read_packets,nb_read_frames,duration'
+    else:
+        count_args = '-count_packets'
+        entries = 'nb_read_packets,duration'
+    out = subprocess_exec(f'''
+        {program}
+            -v error
+            -select_streams v:0
+            {count_args}
+            -show_entries stream={entries}:stream_tags=timecode:format=duration:format_tags=timecode
+            -print_format json
+            "{outpath}"
+        ''')
+    return json.loads(out)
+
+def verify_encode_job(job, item):
+    if not verify.is_enabled():
+        complete_encode_job(job, item)
+        return
+
+    # what the output should have, sequences play at the encode rate
+    frames = preflight.get_item_frame_count(item)
+    if item['type'] == 'sequence' and job.framerate:
+        num, den = framerates[job.framerate]['rate']
+        duration = frames * den / num
+    else:
+        num, den = item['framerate']
+        duration = item['duration']
+    frame_period = den / num if num else 0.0
+    if not frames:
+        # no duration to go by, only the timecode and checksum are checked
+        frames = duration = None
+
+    count_frames = encoding_profiles[job.profile].get('intra_only', False)
+    probe = lambda outpath: probe_output(outpath, count_frames)
+
+    encode_verifying.append(job)
+    verify.verify_output_async(job.outpath, probe, frames, duration, job.timecode, frame_period,
+        lambda result: encode_events.put((job, 'verified', result)))
+
+def finish_verify(job, result):
+    encode_verifying.remove(job)
+    item = media_lookup(job.id)
+    if not item:
+        return
+
+    if result['problems'] and job.cache_hit and not job.proc and not encode_cancelled:
+        # a bad cache entry, drop it and encode after all
+        log.warning(f'cached output failed verification, encoding {job.id}')
+        encodecache.discard(job.cache_key)
+        media_update(job.id, state='queued')
+        encode_queue.append(job)
+        return
+
+    if job.manifest:
+        job.manifest.add(item, result)
+
+    if result['problems']:
+        media_update(job.id, progress=0.0, state='error')
+        update_copies(job, state='error')
+    else:
+        complete_encode_job(job, item)
+
+def complete_encode_job(job, item):
+    media_update(job.id, progress=1.0, state='done', outpath=job.outpath)
+    publish_copies(job)
+    if not job.proc:
+        # served from the cache, nothing was encoded
+        return
+
+    record_encode_history(item, job.profile,
+        frames=job.progress_frames,
+        duration=job.progress_secs or job.duration_secs,
+        wall_time=job.wall_time,
+        outpath=job.outpath)
+
+    if job.cache_key:
+        publish.run_transfer_async(encodecache.store_output,
+            job.outpath, encodecache.get_cache_path(job.cache_key), lambda error: None)
+
+def update_copies(job, **kwargs):
+    for id in job.copies:
+        if media_lookup(id):
+            media_update(id, **kwargs)
+
+def publish_copies(job):
+    # hardlink (or copy) the output for each duplicate
+    for id in job.copies:
+        item = media_lookup(id)
+        if not item:
+            continue
+        copy = EncodeJob(id, job.profile, job.framerate, job.timecode, job.burn_in, job.priority,
+                         outpath=get_item_default_outpath(item))
+        copy.copy_of = job
+        copy.manifest = job.manifest
+        encode_publishing.append(copy)
+        publish.link_output_async(job.outpath, copy.outpath,
+            lambda error, copy=copy: encode_events.put((copy, 'published', error)))
+
+def record_encode_history(item, profile, frames, duration, wall_time, outpath):
+    try:
+        bytes_out = os.path.getsize(outpath)
+    except OSError:
+        bytes_out = 0
+
+    width, height = item['resolution']
+    history.record_encode(
+        item_id=item['id'],
+        type=item['type'],
+        profile=profile,
+        codec=item['codec'],
+        width=width,
+        height=height,
+        pixfmt=item['pixfmt'],
+        frames=frames,
+        duration=duration,
+        wall_time=wall_time,
+        bytes_in=item.get('filesize', 0),
+        bytes_out=bytes_out,
+        )
 
 client_wants_to_join = False
 
@@ -692,14 +1748,24 @@ def dispatch_client_request(cmd, args):
         scan_paths(**args)
     elif cmd == 'encode_items':
         encode_items(**args)
+    elif cmd == 'encode_samples':
+        encode_samples(**args)
     elif cmd == 'cancel_encode':
         cancel_encode()
+    elif cmd == 'pause_encode':
+        pause_encode(**args)
+    elif cmd == 'resume_encode':
+        resume_encode(**args)
+    elif cmd == 'set_encode_priority':
+        set_encode_priority(**args)
     elif cmd == 'remove_items':
         remove_items(**args)
     elif cmd == 'cancel_scan':
         cancel_scan()
     elif cmd == 'preview_item':
         preview_item(**args)
+    elif cmd == 'filmstrip_items':
+        filmstrip_items(**args)
     elif cmd == 'join':
         cancel_scan()
         cancel_encode()
@@ -719,14 +1785,96 @@ def receive_and_dispatch_next_client_request(block=True):
         return ' '.join(
             f'{k}={v}' for k,v in kwargs.items())
 
-    log.debug(f'received: {cmd} {format_kwargs(args)}')
-    dispatch_client_request(cmd, args)
+    log.debug('received: %s %s', cmd, format_kwargs(args))
+    with span(f'ipc.{cmd}'):
+        dispatch_client_request(cmd, args)
     return True
 
 def poll_client():
+    if control_server:
+        control_server.poll()
+    if not engine_conn:
+        # running headless, eg from a benchmark
+        return
     while receive_and_dispatch_next_client_request(False):
         pass
 
+# control api: method -> long running (acknowledged before it's run)
+control_server = None
+control_methods = {
+    'scan_paths': True,
+    'encode_items': True,
+    'encode_samples': True,
+    'cancel_scan': False,
+    'cancel_encode': False,
+    'remove_items': False,
+    'pause_encode': False,
+    'resume_encode': False,
+    'set_encode_priority': False,
+    'filmstrip_items': True,
+    'get_media_items': False,
+    }
+
+def get_media_items(ids=None):
+    ids = ids or media_items.keys()
+    return [media_items[id] for id in ids if id in media_items]
+
+def check_control_request(method, params):
+    """Check params against the engine function a method calls, raising
+    control.InvalidParams.
+    """
+    func = get_media_items if method == 'get_media_items' else globals()[method]
+    try:
+        inspect.signature(func).bind(**params)
+    except TypeError as e:
+        raise control.InvalidParams(str(e))
+
+    def is_list_of_str(value):
+        return isinstance(value, list) and all(isinstance(x, str) for x in value)
+
+    for key in ('ids', 'paths'):
+        if params.get(key) is not None and not is_list_of_str(params[key]):
+            raise control.InvalidParams(f'{key} must be a list of strings')
+    if 'id' in params and not isinstance(params['id'], str):
+        raise control.InvalidParams('id must be a string')
+
+    # before anything is done, not partway through
+    ids = list(params.get('ids') or [])
+    if 'id' in params:
+        ids.append(params['id'])
+    unknown = [id for id in ids if id not in media_items]
+    if unknown:
+        raise control.InvalidParams(f'no item {", ".join(unknown)}')
+
+    if 'profile' in params and params['profile'] not in encoding_profiles:
+        raise control.InvalidParams(f'no profile {params["profile"]}, one of {", ".join(encoding_profiles)}')
+    if params.get('framerate') and params['framerate'] not in framerates:
+        raise control.InvalidParams(f'no framerate {params["framerate"]}, one of {", ".join(framerates)}')
+    if 'priority' in params and not isinstance(params['priority'], int):
+        raise control.InvalidParams('priority must be an integer')
+    if params.get('timecode') and not isinstance(params['timecode'], str):
+        raise control.InvalidParams('timecode must be a string')
+    rate = params.get('sequence_framerate')
+    if rate is not None and not (isinstance(rate, (list, tuple)) and len(rate) == 2
+                                 and all(isinstance(x, int) and x > 0 for x in rate)):
+        raise control.InvalidParams('sequence_framerate must be [numerator, denominator]')
+
+def handle_control_request(method, params):
+    if method == 'get_media_items':
+        return get_media_items(**params)
+
+    with span(f'control.{method}'):
+        dispatch_client_request(method, params)
+
+def start_control_server():
+    global control_server
+    try:
+        control_server = control.ControlServer(
+            config['control'].get('address'),
+            handle_control_request, control_methods, check_control_request)
+    except OSError as e:
+        log.error(f'cannot start control api: {e}')
+
 def start_engine(conn):
     global engine_conn
     engine_conn = conn
@@ -735,10 +1883,32 @@ def start_engine(conn):
     log = logging.getLogger('engine.child')
     setup_logging(color=True)
 
+    try:
+        run_engine()
+    except Exception:
+        log.exception('engine failed')
+        raise
+    finally:
+        # the process exits without running atexit, write out the queue
+        stop_logging()
+
+def run_engine():
     log.debug('start_engine')
+    if control.is_enabled():
+        start_control_server()
+
     while not client_wants_to_join:
-        receive_and_dispatch_next_client_request()
+        if control_server:
+            # wake for either the ui or a control client
+            timeout = 0.1 if control_server.has_pending_output() else None
+            multiprocessing.connection.wait([engine_conn] + control_server.get_sockets(), timeout)
+            poll_client()
+        else:
+            receive_and_dispatch_next_client_request()
 
+    if control_server:
+        control_server.close()
+    profiling.report()
     log.debug('start_engine: exit')
 
 # client
@@ -753,22 +1923,40 @@ class EngineProxy(object):
     def cancel_scan(self):
         self._send_command('cancel_scan')
 
-    def encode_items(self, ids, profile='prores_422', framerate='fps_30', timecode=None, burn_in=False):
-        self._send_command('encode_items', ids=ids, profile=profile, framerate=framerate, timecode=timecode, burn_in=burn_in)
+    def encode_items(self, ids, profile='prores_422', framerate='fps_30', timecode=None, burn_in=False, priority=0):
+        self._send_command('encode_items', ids=ids, profile=profile, framerate=framerate, timecode=timecode, burn_in=burn_in, priority=priority)
+
+    def encode_samples(self, ids, profile='prores_422', framerate='fps_30', timecode=None, burn_in=False):
+        self._send_command('encode_samples', ids=ids, profile=profile, framerate=framerate, timecode=timecode, burn_in=burn_in)
 
     def cancel_encode(self):
         self._send_command('cancel_encode')
 
+    def pause_encode(self, ids):
+        self._send_command('pause_encode', ids=ids)
+
+    def resume_encode(self, ids):
+        self._send_command('resume_encode', ids=ids)
+
+    def set_encode_priority(self, ids, priority):
+        self._send_command('set_encode_priority', ids=ids, priority=priority)
+
     def remove_items(self, ids):
         self._send_command('remove_items', ids=ids)
 
     def preview_item(self, id, framerate):
         self._send_command('preview_item', id=id, framerate=framerate)
 
+    def filmstrip_items(self, ids):
+        self._send_command('filmstrip_items', ids=ids)
+
     def join(self):
         self._send_command('join')
         self._proc.join()
 
+    def fileno(self):
+        return self._conn.fileno()
+
     def poll(self):
         if not self._conn.poll():
             return None
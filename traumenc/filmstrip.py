@@ -0,0 +1,99 @@
+"""Filmstrip thumbnails.
+
+A strip of frames spread through an item, tiled side by side in one
+jpeg, so a shot can be told apart from its neighbours (and its black
+slate) by scrubbing over it in the list. Strips are made on demand and
+kept on disk, keyed by the source's path, sizes and modification times,
+so they survive a rescan.
+"""
+import os
+import json
+import hashlib
+import logging
+
+import clique
+
+from config import config
+
+log = logging.getLogger('engine.filmstrip')
+
+cfg = config['filmstrip']
+
+# bump when the key or how strips are made changes
+filmstrip_version = 1
+
+
+def is_enabled():
+    return cfg.getboolean('enabled')
+
+def get_frame_count():
+    return max(2, cfg.getint('frames'))
+
+def get_frame_indexes(count, frames):
+    """Evenly spaced indexes of frames from count, first and last
+    included.
+    """
+    frames = min(frames, count)
+    if frames < 2:
+        return [0]
+    return [round(i * (count - 1) / (frames - 1)) for i in range(frames)]
+
+def get_frame_times(duration, frames):
+    if not duration:
+        # nothing to spread them over
+        return [0.0]
+    # the middle of each 1/frames of the duration, clear of the ends
+    return [duration * (i + 0.5) / frames for i in range(frames)]
+
+def get_sources(item, frames):
+    """What to tile: the frame files of a sequence, or the times (in
+    seconds) to seek a video to.
+    """
+    if item['type'] == 'sequence':
+        filepaths = list(clique.parse(item['path']))
+        return [filepaths[index] for index in get_frame_indexes(len(filepaths), frames)]
+    return get_frame_times(item['duration'], frames)
+
+def get_key(item, frames, height):
+    if item['type'] == 'sequence':
+        files = list(clique.parse(item['path']))
+        files = [files[0], files[-1]]
+    else:
+        files = [item['path']]
+
+    stats = []
+    for filepath in files:
+        st = os.stat(filepath)
+        stats.append((st.st_size, st.st_mtime_ns))
+
+    ob = [filmstrip_version, item['path'], stats, frames, height]
+    data = json.dumps(ob).encode('utf8')
+    return hashlib.sha256(data).hexdigest()
+
+def get_cache_path(key):
+    return os.path.join(cfg.get('dir'), key[:2], f'{key}.jpg')
+
+def load(key):
+    if not cfg.get('dir'):
+        return None
+    try:
+        with open(get_cache_path(key), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        log.warning(f'cannot read filmstrip {key}: {e}')
+        return None
+
+def store(key, data):
+    if not cfg.get('dir'):
+        return
+    cachepath = get_cache_path(key)
+    temppath = f'{cachepath}.tmp'
+    try:
+        os.makedirs(os.path.dirname(cachepath), exist_ok=True)
+        with open(temppath, 'wb') as f:
+            f.write(data)
+        os.replace(temppath, cachepath)
+    except OSError as e:
+        log.warning(f'cannot store filmstrip {key}: {e}')
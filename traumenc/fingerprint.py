@@ -0,0 +1,109 @@
+"""Source identity and content fingerprints.
+
+Copies of a source are found by file identity (st_dev, st_ino) where
+they're hardlinks, otherwise by size and a hash of a few sampled blocks
+(head, tail and some evenly spaced in between) rather than the whole
+file. Sequences are sampled from their first, middle and last frames.
+Sampled matches can be confirmed by comparing the files in full, which
+still costs less than the encode it saves.
+"""
+import os
+import hashlib
+import logging
+
+import clique
+
+from config import config
+
+log = logging.getLogger('engine.fingerprint')
+
+cfg = config['dedupe']
+
+compare_chunk_size = 4 * 1024 * 1024
+
+
+def get_item_files(item):
+    if item['type'] == 'sequence':
+        return list(clique.parse(item['path']))
+    return [item['path']]
+
+def get_file_identity(filepath):
+    st = os.stat(filepath)
+    return (st.st_dev, st.st_ino)
+
+def get_item_identity(item):
+    """Hardlinked sources share an identity. For sequences it's the
+    first frame's, with the frame count.
+    """
+    files = get_item_files(item)
+    return get_file_identity(files[0]) + (len(files),)
+
+def hash_file_samples(h, filepath):
+    block_size = cfg.getint('block_size_kb') * 1024
+    blocks = cfg.getint('sample_blocks')
+    size = os.path.getsize(filepath)
+    h.update(size.to_bytes(8, 'little'))
+
+    with open(filepath, 'rb') as f:
+        if size <= block_size * (blocks + 2):
+            # small enough to hash all of it
+            h.update(f.read())
+            return
+
+        offsets = [0, size - block_size]
+        step = (size - block_size) // (blocks + 1)
+        offsets[1:1] = [step * (i + 1) for i in range(blocks)]
+        for offset in offsets:
+            f.seek(offset)
+            h.update(f.read(block_size))
+
+def get_item_fingerprint(item, all_sizes=False, mtimes=False):
+    """A hash of sampled content, equal for copies of the same source.
+    With all_sizes, every file's size is included too, so a frame that
+    isn't sampled changing size changes it. With mtimes, every file's
+    modification time is as well, which catches same-size changes
+    between the samples, but copies only match if they kept their
+    times.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(item['type'].encode('utf8'))
+    files = get_item_files(item)
+    h.update(len(files).to_bytes(8, 'little'))
+
+    if all_sizes or mtimes:
+        for filepath in files:
+            st = os.stat(filepath)
+            if all_sizes:
+                h.update(st.st_size.to_bytes(16, 'little'))
+            if mtimes:
+                h.update(st.st_mtime_ns.to_bytes(16, 'little'))
+
+    if len(files) > 3:
+        files = [files[0], files[len(files) // 2], files[-1]]
+    for filepath in files:
+        hash_file_samples(h, filepath)
+    return h.hexdigest()
+
+def compare_files(path_a, path_b, should_stop):
+    if os.path.getsize(path_a) != os.path.getsize(path_b):
+        return False
+    with open(path_a, 'rb') as fa, open(path_b, 'rb') as fb:
+        while True:
+            if should_stop():
+                return False
+            data = fa.read(compare_chunk_size)
+            if data != fb.read(compare_chunk_size):
+                return False
+            if not data:
+                return True
+
+def compare_items(a, b, should_stop=lambda: False):
+    """True if two items' files are byte for byte the same. Compared a
+    chunk at a time, should_stop() is called between chunks and stopping
+    counts as different.
+    """
+    files_a = get_item_files(a)
+    files_b = get_item_files(b)
+    if len(files_a) != len(files_b):
+        return False
+    return all(compare_files(fa, fb, should_stop) for fa, fb in zip(files_a, files_b))
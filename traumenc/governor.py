@@ -0,0 +1,201 @@
+"""Adaptive encode concurrency.
+
+Samples system load, memory and pressure stall information from /proc
+and the cpu used by the running ffmpeg processes, and raises or lowers
+the number of concurrent encodes (and the -threads given to each) to
+keep the machine near a target utilisation without swapping. Off
+linux, where /proc isn't available, the configured limits are used.
+"""
+import os
+import time
+import logging
+
+from config import config
+
+log = logging.getLogger('engine.governor')
+
+cfg = config['governor']
+
+clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def read_loadavg():
+    try:
+        with open('/proc/loadavg') as f:
+            return float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        if hasattr(os, 'getloadavg'):
+            return os.getloadavg()[0]
+        return None
+
+def read_meminfo():
+    """Returns {name: bytes} from /proc/meminfo.
+    """
+    info = {}
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                fields = value.split()
+                if fields:
+                    info[name] = int(fields[0]) * 1024
+    except OSError:
+        pass
+    return info
+
+def read_pressure(resource):
+    """Returns the 'some' avg10 stall percentage for cpu, memory or io,
+    or None when the kernel doesn't have psi.
+    """
+    try:
+        with open(f'/proc/pressure/{resource}') as f:
+            for line in f:
+                fields = line.split()
+                if fields[0] == 'some':
+                    return float(fields[1].partition('=')[2])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def read_process_cpu_ticks(pid):
+    # utime + stime, the fields after the parenthesised command name
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+        fields = stat[stat.rindex(')') + 2:].split()
+        return int(fields[11]) + int(fields[12])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Governor(object):
+    def __init__(self):
+        self.cpu_count = os.cpu_count() or 1
+        self.min_jobs = max(1, cfg.getint('min_jobs'))
+        self.max_jobs = cfg.getint('max_jobs') or self.cpu_count
+        self.target_load = cfg.getfloat('target_load')
+        self.min_available = cfg.getint('min_available_mb') * 1024 * 1024
+        self.max_memory_pressure = cfg.getfloat('max_memory_pressure')
+        self.max_io_pressure = cfg.getfloat('max_io_pressure')
+        self.interval = cfg.getfloat('interval')
+
+        self.jobs = self.min_jobs
+        self._last_update = 0.0
+        self._cpu_ticks = {}   # pid -> (ticks, time)
+
+    def get_threads(self):
+        """Threads for each ffmpeg, sharing the target cpu between jobs.
+        """
+        cores = self.cpu_count * self.target_load
+        return max(1, int(round(cores / self.jobs)))
+
+    def sample(self, pids):
+        sample = {
+            'load': read_loadavg(),
+            'cpu_pressure': read_pressure('cpu'),
+            'memory_pressure': read_pressure('memory'),
+            'io_pressure': read_pressure('io'),
+            }
+
+        meminfo = read_meminfo()
+        sample['mem_available'] = meminfo.get('MemAvailable')
+        swap_total = meminfo.get('SwapTotal', 0)
+        sample['swap_used'] = swap_total - meminfo.get('SwapFree', swap_total)
+
+        # cores used by each job since the last sample
+        now = time.time()
+        usage = []
+        cpu_ticks = {}
+        for pid in pids:
+            ticks = read_process_cpu_ticks(pid)
+            if ticks is None:
+                continue
+            cpu_ticks[pid] = (ticks, now)
+            last = self._cpu_ticks.get(pid)
+            if last and now > last[1]:
+                usage.append((ticks - last[0]) / clock_ticks / (now - last[1]))
+        self._cpu_ticks = cpu_ticks
+        sample['job_cpu'] = sum(usage) / len(usage) if usage else None
+        return sample
+
+    def decide(self, sample, running, waiting):
+        """Returns (jobs, reason) for one sample.
+        """
+        jobs = self.jobs
+        load = sample['load']
+        utilisation = load / self.cpu_count if load is not None else None
+        mem_available = sample['mem_available']
+        memory_pressure = sample['memory_pressure']
+        io_pressure = sample['io_pressure']
+        job_cpu = sample['job_cpu']
+
+        # memory first, swapping costs far more than an idle core
+        if mem_available is not None and mem_available < self.min_available:
+            return jobs - 1, 'low memory'
+        if memory_pressure is not None and memory_pressure > self.max_memory_pressure:
+            return jobs - 1, 'memory pressure'
+        if utilisation is not None and utilisation > self.target_load * 1.1:
+            return jobs - 1, 'overloaded'
+
+        # only grow when every slot is busy and there's more to do
+        if running < jobs or not waiting:
+            return jobs, 'idle slots'
+        if io_pressure is not None and io_pressure > self.max_io_pressure:
+            # more readers on a saturated disk won't help
+            return jobs, 'io pressure'
+        if utilisation is not None and utilisation < self.target_load * 0.8:
+            return jobs + 1, 'underloaded'
+        if job_cpu is not None and job_cpu < 0.5 * self.get_threads():
+            # jobs are waiting on reads rather than cpu, overlap more of them
+            return jobs + 1, 'jobs stalled'
+        return jobs, 'on target'
+
+    def update(self, pids, waiting):
+        """Called from the encode loop, returns the current job limit.
+        """
+        now = time.time()
+        if now - self._last_update < self.interval:
+            return self.jobs
+        self._last_update = now
+
+        sample = self.sample(pids)
+        jobs, reason = self.decide(sample, len(pids), waiting)
+        jobs = max(self.min_jobs, min(self.max_jobs, jobs))
+
+        summary = format_sample(sample)
+        if jobs != self.jobs:
+            log.info(f'governor: jobs {self.jobs} -> {jobs} ({reason}), {summary}')
+            self.jobs = jobs
+            log.info(f'governor: threads per job {self.get_threads()}')
+        else:
+            log.debug(f'governor: jobs {jobs} ({reason}), {summary}')
+        return self.jobs
+
+
+def format_sample(sample):
+    parts = []
+    if sample['load'] is not None:
+        parts.append(f'load {sample["load"]:.2f}')
+    if sample['job_cpu'] is not None:
+        parts.append(f'job cpu {sample["job_cpu"]:.2f}')
+    if sample['mem_available'] is not None:
+        parts.append(f'mem {sample["mem_available"] // (1024 * 1024)}M free')
+    if sample['swap_used']:
+        parts.append(f'swap {sample["swap_used"] // (1024 * 1024)}M used')
+    for name in ('cpu', 'memory', 'io'):
+        value = sample[f'{name}_pressure']
+        if value is not None:
+            parts.append(f'psi {name} {value:.1f}')
+    return ', '.join(parts)
+
+
+governor = None
+
+def get_governor():
+    global governor
+    if governor is None:
+        governor = Governor()
+    return governor
+
+def is_enabled():
+    return cfg.getboolean('enabled')
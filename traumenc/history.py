@@ -0,0 +1,251 @@
+"""Encode history database.
+
+One row is stored per completed encode, and can be summarized or
+exported for monitoring:
+
+    $ python traumenc/history.py summary
+    $ python traumenc/history.py prometheus traumenc.prom
+    $ python traumenc/history.py json history.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import logging
+import argparse
+
+from config import config
+from utils import format_size
+
+log = logging.getLogger('engine.history')
+
+cfg = config['history']
+
+history_columns = [
+    ('time', 'REAL'),
+    ('host', 'TEXT'),
+    ('item_id', 'TEXT'),
+    ('type', 'TEXT'),
+    ('profile', 'TEXT'),
+    ('codec', 'TEXT'),
+    ('width', 'INTEGER'),
+    ('height', 'INTEGER'),
+    ('pixfmt', 'TEXT'),
+    ('frames', 'INTEGER'),
+    ('duration', 'REAL'),
+    ('wall_time', 'REAL'),
+    ('fps', 'REAL'),
+    ('speed', 'REAL'),
+    ('bytes_in', 'INTEGER'),
+    ('bytes_out', 'INTEGER'),
+    ]
+
+history_db = None
+
+def open_history_db(filepath=None):
+    if not filepath:
+        filepath = cfg.get('database')
+    db = sqlite3.connect(filepath)
+    db.row_factory = sqlite3.Row
+    columns = ', '.join(f'{name} {type}' for name, type in history_columns)
+    db.execute(f'CREATE TABLE IF NOT EXISTS encodes ({columns})')
+    db.execute('CREATE INDEX IF NOT EXISTS encodes_profile ON encodes (profile, time)')
+    return db
+
+def get_history_db():
+    global history_db
+    if history_db is None:
+        history_db = open_history_db()
+    return history_db
+
+def is_enabled():
+    return cfg.getboolean('enabled') and bool(cfg.get('database'))
+
+def record_encode(**fields):
+    if not is_enabled():
+        return
+
+    fields.setdefault('time', time.time())
+    fields.setdefault('host', socket.gethostname())
+
+    wall_time = fields.get('wall_time', 0.0)
+    if wall_time > 0.0:
+        fields['fps'] = fields.get('frames', 0) / wall_time
+        fields['speed'] = fields.get('duration', 0.0) / wall_time
+
+    names = [name for name, _ in history_columns if name in fields]
+    values = [fields[name] for name in names]
+    placeholders = ', '.join('?' * len(names))
+
+    try:
+        db = get_history_db()
+        with db:
+            db.execute(
+                f'INSERT INTO encodes ({", ".join(names)}) VALUES ({placeholders})',
+                values)
+    except sqlite3.Error as e:
+        log.error(f'failed to record encode history: {e}')
+        return
+
+    log.info(f'history: {fields["item_id"]} {fields.get("profile")} '
+             f'{fields.get("fps", 0.0):.1f} fps, {fields.get("speed", 0.0):.2f}x')
+
+    prom_path = cfg.get('prometheus_file')
+    if prom_path:
+        try:
+            write_prometheus(prom_path, db)
+        except (OSError, sqlite3.Error) as e:
+            log.error(f'failed to write {prom_path}: {e}')
+
+
+def query_profile_summary(db, since=None):
+    """Aggregate throughput per (host, profile, resolution).
+    """
+    where = 'WHERE time >= ?' if since else ''
+    args = (since,) if since else ()
+    rows = db.execute(f'''
+        SELECT
+            host, profile, width, height,
+            COUNT(*) AS jobs,
+            SUM(frames) AS frames,
+            SUM(duration) AS duration,
+            SUM(wall_time) AS wall_time,
+            SUM(bytes_in) AS bytes_in,
+            SUM(bytes_out) AS bytes_out,
+            MAX(time) AS last_time
+        FROM encodes {where}
+        GROUP BY host, profile, width, height
+        ORDER BY host, profile, width, height
+        ''', args)
+
+    summary = []
+    for row in rows:
+        ob = dict(row)
+        wall_time = ob['wall_time'] or 0.0
+        ob['fps'] = ob['frames'] / wall_time if wall_time else 0.0
+        ob['speed'] = ob['duration'] / wall_time if wall_time else 0.0
+        summary.append(ob)
+    return summary
+
+
+def query_profile_rates(db, host=None, min_jobs=3):
+    """Measured output bytes per pixel and encode pixel rate per profile,
+    for calibrating estimates. Only profiles with enough history are
+    included.
+    """
+    where = 'WHERE frames > 0 AND wall_time > 0'
+    args = ()
+    if host:
+        where += ' AND host = ?'
+        args = (host,)
+    rows = db.execute(f'''
+        SELECT
+            profile,
+            COUNT(*) AS jobs,
+            SUM(CAST(frames AS REAL) * width * height) AS pixels,
+            SUM(bytes_out) AS bytes_out,
+            SUM(wall_time) AS wall_time
+        FROM encodes {where}
+        GROUP BY profile
+        ''', args)
+
+    rates = {}
+    for row in rows:
+        if row['jobs'] < min_jobs or not row['pixels']:
+            continue
+        rates[row['profile']] = {
+            'bytes_per_pixel': row['bytes_out'] / row['pixels'],
+            'pixel_rate': row['pixels'] / row['wall_time'],
+            }
+    return rates
+
+
+def format_prometheus(summary):
+    metrics = [
+        ('jobs', 'counter', 'Number of completed encodes'),
+        ('frames', 'counter', 'Frames encoded'),
+        ('wall_time', 'counter', 'Seconds spent encoding'),
+        ('bytes_in', 'counter', 'Source bytes read'),
+        ('bytes_out', 'counter', 'Output bytes written'),
+        ('fps', 'gauge', 'Average encode frames per second'),
+        ('speed', 'gauge', 'Average encode speed relative to realtime'),
+        ]
+
+    lines = []
+    for key, type, help in metrics:
+        name = f'traumenc_encode_{key}'
+        if type == 'counter':
+            name += '_total'
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} {type}')
+        for ob in summary:
+            labels = (
+                f'host="{ob["host"]}",profile="{ob["profile"]}",'
+                f'resolution="{ob["width"]}x{ob["height"]}"')
+            lines.append(f'{name}{{{labels}}} {ob[key] or 0}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(filepath, db=None):
+    if db is None:
+        db = get_history_db()
+    text = format_prometheus(query_profile_summary(db))
+
+    # write then rename, so the node exporter never sees a partial file
+    temppath = f'{filepath}.tmp'
+    with open(temppath, 'w') as f:
+        f.write(text)
+    os.replace(temppath, filepath)
+
+
+def write_json(filepath, db=None):
+    if db is None:
+        db = get_history_db()
+    ob = {
+        'summary': query_profile_summary(db),
+        'encodes': [dict(row) for row in db.execute('SELECT * FROM encodes ORDER BY time')],
+        }
+    with open(filepath, 'w') as f:
+        json.dump(ob, f, indent=2)
+
+
+def format_summary(summary):
+    lines = [f'{"host":16} {"profile":18} {"resolution":>11} {"jobs":>6} {"frames":>9} '
+             f'{"fps":>8} {"speed":>7} {"in":>10} {"out":>10}']
+    for ob in summary:
+        resolution = f'{ob["width"]}x{ob["height"]}'
+        lines.append(
+            f'{ob["host"]:16.16} {ob["profile"]:18.18} {resolution:>11} {ob["jobs"]:6} '
+            f'{ob["frames"] or 0:9} {ob["fps"]:8.1f} {ob["speed"]:6.2f}x '
+            f'{format_size(ob["bytes_in"] or 0):>10} {format_size(ob["bytes_out"] or 0):>10}')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Encode history tools.')
+    parser.add_argument('--db', help='history database (default from config)')
+    parser.add_argument('--days', type=float, help='only include the last N days')
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('summary', help='print throughput per profile')
+    p = sub.add_parser('prometheus', help='write a prometheus textfile')
+    p.add_argument('filepath')
+    p = sub.add_parser('json', help='write summary and records as json')
+    p.add_argument('filepath')
+    args = parser.parse_args()
+
+    db = open_history_db(args.db)
+    command = args.command or 'summary'
+
+    if command == 'summary':
+        since = time.time() - args.days * 86400 if args.days else None
+        print(format_summary(query_profile_summary(db, since)))
+    elif command == 'prometheus':
+        write_prometheus(args.filepath, db)
+    elif command == 'json':
+        write_json(args.filepath, db)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
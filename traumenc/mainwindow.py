@@ -1,27 +1,33 @@
+import time
 import logging
+import platform
 
 from PyQt5.QtWidgets import (
         QMainWindow, QAction, QFileDialog, QComboBox, QLabel,
-        QWidget, QSizePolicy, QLineEdit, QCheckBox,
+        QWidget, QSizePolicy, QLineEdit, QCheckBox, QMessageBox,
         qApp,
         )
 from PyQt5.QtGui import (
-        QIcon,
+        QIcon, QDesktopServices,
         )
 from PyQt5.QtCore import (
-        Qt, QSize, QTimer, QPersistentModelIndex,
+        Qt, QSize, QTimer, QSocketNotifier, QPersistentModelIndex, QUrl,
         )
 
-from medialist import MediaListView, MediaListModel
+from medialist import MediaListView, MediaListModel, MediaListFilterModel, state_colors
 from encodingprofiles import encoding_profiles, framerates
 from config import config
 from utils import sanitize_timecode
+from preflight import format_estimate
 
 
 log = logging.getLogger('app')
 
 app_title = 'Traum Encoder'
 
+# encodes started with "Encode Urgent" preempt everything else
+urgent_priority = 10
+
 
 icon_cache = {}
 def get_icon(name):
@@ -107,6 +113,30 @@ class MainWindow(QMainWindow):
             handler=self._encode_or_cancel)
         self._action_encode = action_encode
 
+        action_encode_urgent = make_action(
+            text='Encode &Urgent',
+            tip='Encode selection ahead of everything queued',
+            key='Ctrl+Shift+E',
+            handler=self._encode_urgent)
+
+        action_encode_samples = make_action(
+            text='Encode &Samples',
+            tip='Encode a few seconds of the selection or all, to check the settings',
+            key='Ctrl+Shift+S',
+            handler=self._encode_samples)
+
+        action_pause = make_action(
+            text='&Pause',
+            tip='Pause encoding the selection',
+            key='Ctrl+P',
+            handler=self._pause_selection)
+
+        action_resume = make_action(
+            text='&Resume',
+            tip='Resume encoding the selection',
+            key='Ctrl+R',
+            handler=self._resume_selection)
+
         menubar = self.menuBar()
 
         menu = menubar.addMenu('&File')
@@ -118,6 +148,13 @@ class MainWindow(QMainWindow):
         menu = menubar.addMenu('&Edit')
         menu.addAction(action_delete)
 
+        menu = menubar.addMenu('E&ncode')
+        menu.addAction(action_encode_urgent)
+        menu.addAction(action_encode_samples)
+        menu.addSeparator()
+        menu.addAction(action_pause)
+        menu.addAction(action_resume)
+
         burn_in = make_action('Timecode Burn-in')
         burn_in.setCheckable(True)
         menu = menubar.addMenu('&Filters')
@@ -182,12 +219,102 @@ class MainWindow(QMainWindow):
         toolbar.setToolButtonStyle(Qt.ToolButtonTextUnderIcon)
 
         self._init_listview()
+        self._init_filterbar()
+
+    def _init_filterbar(self):
+        self.addToolBarBreak()
+        toolbar = self.addToolBar('Filter')
+
+        search = QLineEdit()
+        search.setPlaceholderText('Search...')
+        search.setClearButtonEnabled(True)
+        search.setMaximumWidth(200)
+        toolbar.addWidget(search)
+        self._lineedit_search = search
+
+        # don't refilter on every keystroke
+        timer = QTimer(self)
+        timer.setSingleShot(True)
+        timer.setInterval(150)
+        timer.timeout.connect(self._apply_filter)
+        search.textChanged.connect(timer.start)
+
+        def add_combo(label, choices):
+            combo = QComboBox()
+            combo.addItem(label, userData=None)
+            for text, data in choices:
+                combo.addItem(text, userData=data)
+            toolbar.addWidget(combo)
+            return combo
+
+        combo = add_combo('All states', [(state.capitalize(), state) for state in state_colors])
+        combo.currentIndexChanged.connect(self._apply_filter)
+        self._combo_filter_state = combo
+
+        combo = add_combo('All codecs', [])
+        combo.currentIndexChanged.connect(self._apply_filter)
+        self._combo_filter_codec = combo
+
+        combo = add_combo('All resolutions', [])
+        combo.currentIndexChanged.connect(self._apply_filter)
+        self._combo_filter_resolution = combo
+
+        spacer = QWidget()
+        spacer.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        toolbar.addWidget(spacer)
+
+        combo = add_combo('Sort by added', [
+            ('Sort by name', 'name'),
+            ('Sort by duration', 'duration'),
+            ('Sort by size', 'filesize'),
+            ('Sort by state', 'state'),
+            ('Sort by resolution', 'resolution'),
+            ('Sort by codec', 'codec'),
+            ])
+        combo.currentIndexChanged.connect(self._apply_sort)
+        self._combo_sort = combo
+
+        reverse = QCheckBox('Reverse')
+        reverse.toggled.connect(self._apply_sort)
+        toolbar.addWidget(reverse)
+        self._checkbox_sort_reverse = reverse
+
+    def _apply_filter(self):
+        self._filter.set_filter(
+            states=[self._combo_filter_state.currentData()] if self._combo_filter_state.currentData() else None,
+            codec=self._combo_filter_codec.currentData(),
+            resolution=self._combo_filter_resolution.currentData(),
+            text=self._lineedit_search.text())
+
+    def _apply_sort(self):
+        self._filter.set_sort_key(
+            self._combo_sort.currentData(),
+            self._checkbox_sort_reverse.isChecked())
+
+    def _refresh_filter_choices(self):
+        """Update codec and resolution filters from the items in the list.
+        """
+        def refresh(combo, values, format):
+            current = combo.currentData()
+            combo.blockSignals(True)
+            while combo.count() > 1:
+                combo.removeItem(1)
+            for value in values:
+                combo.addItem(format(value), userData=value)
+            index = combo.findData(current) if current else 0
+            combo.setCurrentIndex(max(0, index))
+            combo.blockSignals(False)
+
+        refresh(self._combo_filter_codec,
+            self._model.get_distinct_values('codec'), str)
+        refresh(self._combo_filter_resolution,
+            self._model.get_distinct_values('resolution'), lambda r: f'{r[0]}x{r[1]}')
 
     def _get_selected_media_ids(self, clear=False):
         sel = self._view.selectionModel()
         media_ids = []
         for idx in sel.selectedIndexes():
-            media_id = self._model.get_media_id_for_index(idx)
+            media_id = self._filter.get_media_id_for_index(idx)
             media_ids.append(media_id)
         if clear:
             sel.clear()
@@ -211,24 +338,82 @@ class MainWindow(QMainWindow):
             action.setIcon(get_icon('gears'))
             action.setText('Encode')
 
-    def _encode_selection(self):
-        if self._is_scanning:
+    def _encode_urgent(self):
+        media_ids = self._get_selected_media_ids()
+        states = {id: self._model._find_item_with_id(id)['state'] for id in media_ids}
+
+        # already queued items just move up
+        queued = [id for id in media_ids if states[id] in ('queued', 'paused', 'encoding')]
+        if queued:
+            self._engine.set_encode_priority(queued, urgent_priority)
+
+        if any(state == 'ready' for state in states.values()):
+            if self._encode_selection(priority=urgent_priority, selected_only=True):
+                self._set_encoding_state(True)
+
+    def _encode_samples(self):
+        if self._is_scanning or self._is_encoding:
             return
 
         media_ids = self._get_selected_media_ids(True)
-        profile = self._combo_profile.currentData()
-        framerate = self._combo_framerate.currentData()
-
+        if not media_ids and self._filter.is_filtered():
+            media_ids = [item['id'] for item in self._filter.get_visible_media_items()
+                         if item.get('state') == 'ready']
+            if not media_ids:
+                self._status('Nothing to encode')
+                return
+
+        settings = self._get_encode_settings()
+        log.info(f'encode samples: {settings["profile"]} {settings["framerate"]}, {len(media_ids)} items')
+        self._status('Encoding samples...')
+        self._engine.encode_samples(ids=media_ids, **settings)
+        self._set_encoding_state(True)
+
+    def _get_encode_settings(self):
         text = self._lineedit_timecode.text()
-        timecode = text if text else None
-
         b = self._action_burn_in.isChecked()
-        burn_in = True if b else None
+        return dict(
+            profile=self._combo_profile.currentData(),
+            framerate=self._combo_framerate.currentData(),
+            timecode=text if text else None,
+            burn_in=True if b else None,
+            )
+
+    def _pause_selection(self):
+        media_ids = self._get_selected_media_ids()
+        if media_ids:
+            self._engine.pause_encode(media_ids)
+
+    def _resume_selection(self):
+        media_ids = self._get_selected_media_ids()
+        if media_ids:
+            self._engine.resume_encode(media_ids)
 
-        log.info(f'encode selection: {profile} {framerate}, {len(media_ids)} items')
+    def _encode_selection(self, priority=0, selected_only=False):
+        if self._is_scanning:
+            return
+
+        media_ids = self._get_selected_media_ids(True)
+        if selected_only:
+            # only ready items, the rest are already queued or done
+            media_ids = [id for id in media_ids
+                         if self._model._find_item_with_id(id)['state'] == 'ready']
+            if not media_ids:
+                self._status('Nothing to encode')
+                return
+        if not media_ids and self._filter.is_filtered():
+            # encode what's showing, rather than everything
+            media_ids = [item['id'] for item in self._filter.get_visible_media_items()
+                         if item.get('state') == 'ready']
+            if not media_ids:
+                self._status('Nothing to encode')
+                return
+
+        settings = self._get_encode_settings()
+        log.info(f'encode selection: {settings["profile"]} {settings["framerate"]}, {len(media_ids)} items')
         self._status(f'Encoding {len(media_ids)} items...')
 
-        self._engine.encode_items(ids=media_ids, profile=profile, framerate=framerate, timecode=timecode, burn_in=burn_in)
+        self._engine.encode_items(ids=media_ids, priority=priority, **settings)
         return True
 
     def _delete_selection(self):
@@ -269,17 +454,23 @@ class MainWindow(QMainWindow):
 
     def _init_listview(self):
         self._model = MediaListModel()
+        self._filter = MediaListFilterModel(self)
+        self._filter.setSourceModel(self._model)
         self._view = MediaListView(self)
-        self._view.setModel(self._model)
+        self._view.setModel(self._filter)
         self.setCentralWidget(self._view)
         self._view.doubleClicked.connect(self._preview_item)
+        self._view.filmstrip_requested.connect(self._request_filmstrip)
 
     def _preview_item(self, idx):
-        media_id = self._model.get_media_id_for_index(idx)
+        media_id = self._filter.get_media_id_for_index(idx)
         log.info(f'preview item {media_id}')
         framerate = self._combo_framerate.currentData()
         self._engine.preview_item(media_id, framerate)
 
+    def _request_filmstrip(self, id):
+        self._engine.filmstrip_items([id])
+
     def dragEnterEvent(self, e):
         e.accept()
 
@@ -308,22 +499,67 @@ class MainWindow(QMainWindow):
 
     def _init_engine(self, engine):
         self._engine = engine
-        timer = QTimer(self)
-        timer.timeout.connect(self._poll_engine)
-        timer.setInterval(config['ui'].getint('engine_poll_interval'))
-        timer.start()
+        self._engine_drain_budget = config['ui'].getint('engine_drain_budget') / 1000.0
+
+        if platform.system() != 'Windows':
+            # wake up as soon as the engine sends something
+            notifier = QSocketNotifier(engine.fileno(), QSocketNotifier.Read, self)
+            notifier.activated.connect(self._poll_engine)
+            self._engine_notifier = notifier
+        else:
+            # windows pipes can't be watched by a socket notifier
+            timer = QTimer(self)
+            timer.timeout.connect(self._poll_engine)
+            timer.setInterval(config['ui'].getint('engine_poll_interval'))
+            timer.start()
 
     def _poll_engine(self):
         """Respond to engine events.
+
+        Runs of media updates and deletes are applied to the model as a
+        batch, flushed whenever a different event comes along so that
+        ordering is preserved. Draining stops once the time budget is
+        spent, and carries on after the UI has had a turn.
         """
+        deadline = time.perf_counter() + self._engine_drain_budget
+        updates = []
+        deletes = []
+
+        def flush():
+            if updates:
+                self._model._apply_updates(updates)
+                updates.clear()
+            if deletes:
+                log.debug(f'media_delete {len(deletes)} items')
+                self._model._remove_items_by_id(deletes)
+                deletes.clear()
+
         while True:
+            if time.perf_counter() > deadline:
+                QTimer.singleShot(0, self._poll_engine)
+                break
+
             msg = self._engine.poll()
-            if msg:
-                event, args = msg[0], msg[1:]
-                self._dispatch_engine_event(event, args)
-            else:
+            if not msg:
                 break
 
+            event, args = msg[0], msg[1:]
+            if event == 'media_update':
+                if deletes:
+                    flush()
+                id, data = args
+                data['id'] = id
+                updates.append(data)
+            elif event == 'media_delete':
+                if updates:
+                    flush()
+                deletes.append(args[0])
+            else:
+                flush()
+                self._dispatch_engine_event(event, args)
+
+        flush()
+
     def _dispatch_engine_event(self, event, args):
         """Dispatch event to handler if one exists.
         """
@@ -333,15 +569,6 @@ class MainWindow(QMainWindow):
         else:
             log.warn(f'unhandled engine event: {event} {args}')
 
-    def _on_engine_media_update(self, id, data):
-        #log.debug(f'media_update {id} ({",".join(data.keys())})')
-        data['id'] = id
-        self._model._update_item(data)
-
-    def _on_engine_media_delete(self, id):
-        log.debug(f'media_delete {id}')
-        self._model._remove_item_by_id(id)
-
     def _on_engine_scan_update(self, dirs, files):
         log.debug(f'scan_update: {dirs} dirs, {files} files')
         self._status(f'Scanning {dirs} folders, {files} files...')
@@ -351,19 +578,46 @@ class MainWindow(QMainWindow):
         self._status('Scan complete')
         self._is_scanning = False
         self._action_cancel_scan.setEnabled(False)
+        self._refresh_filter_choices()
 
     def _on_engine_scan_cancelled(self):
         log.debug('scan_cancelled')
         self._status('Scan cancelled')
         self._is_scanning = False
         self._action_cancel_scan.setEnabled(False)
+        self._refresh_filter_choices()
 
     def _on_engine_encode_cancelled(self):
         log.debug('encode_cancelled')
         self._status('Encode cancelled')
         self._set_encoding_state(False)
 
+    def _on_engine_encode_estimate(self, estimate, problems):
+        log.debug(f'encode_estimate: {estimate}')
+        text = f'Encoding {format_estimate(estimate)}...'
+        if problems:
+            text += ' Warning: low disk space on ' + '; '.join(problems)
+        self._status(text)
+
+    def _on_engine_encode_refused(self, problems):
+        log.debug('encode_refused')
+        self._status('Encode refused: not enough disk space')
+        # an earlier batch may still be running, only this one was refused
+        if not any(item.get('state') in ('queued', 'encoding', 'paused') for item in self._model._items):
+            self._set_encoding_state(False)
+        QMessageBox.warning(self, app_title,
+            'Not enough disk space for this encode:\n\n' + '\n'.join(problems))
+
     def _on_engine_encode_complete(self):
         log.debug('encode_complete')
         self._status('Encode complete')
         self._set_encoding_state(False)
+
+    def _on_engine_sample_complete(self, dirpath):
+        log.debug(f'sample_complete: {dirpath}')
+        self._set_encoding_state(False)
+        if not dirpath:
+            self._status('Nothing to sample')
+            return
+        self._status(f'Samples encoded to {dirpath}')
+        QDesktopServices.openUrl(QUrl.fromLocalFile(dirpath))
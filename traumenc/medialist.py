@@ -1,32 +1,207 @@
+from collections import OrderedDict
+
 from PyQt5.QtWidgets import (
         qApp, QListView,
-        QStyledItemDelegate, QStyle, QStyleOptionProgressBar,
+        QStyledItemDelegate, QStyle,
         )
 from PyQt5.QtGui import (
-        QImage, QFont, QBrush,
-        QTextDocument,
+        QImage, QFont, QBrush, QColor,
+        QTextDocument, QPixmap, QPainter, QImageReader,
         )
 from PyQt5.QtCore import (
-        Qt, QAbstractListModel,
-        QSize, QRect,
-        QModelIndex,
+        Qt, QAbstractListModel, QSortFilterProxyModel, QAbstractProxyModel,
+        QObject, QRunnable, QThreadPool,
+        QSize, QRect, QPoint, QTimer, QBuffer, QByteArray, QIODevice,
+        QModelIndex, QPersistentModelIndex, pyqtSignal,
         )
 
 from utils import format_size
 from config import config
 
 class MediaListView(QListView):
+    # an item's filmstrip is wanted from the engine
+    filmstrip_requested = pyqtSignal(str)
+
     def __init__(self, parent=None):
         QListView.__init__(self, parent)
         delegate = MediaItemDelegate()
         self.setItemDelegate(delegate)
         self.setSelectionMode(QListView.SelectionMode.ExtendedSelection)
 
+        # scrub through filmstrips by hovering over thumbnails
+        self._filmstrips = config['filmstrip'].getboolean('enabled')
+        self._hover_index = QPersistentModelIndex()
+        self.setMouseTracking(self._filmstrips)
+
+        # thumbnails are decoded for rows in or near the viewport,
+        # checked shortly after anything scrolls or changes
+        self._prefetch_rows = config['ui'].getint('thumbnail_prefetch_rows')
+        timer = QTimer(self)
+        timer.setSingleShot(True)
+        timer.setInterval(50)
+        timer.timeout.connect(self._prefetch_thumbnails)
+        self._prefetch_timer = timer
+        self.verticalScrollBar().valueChanged.connect(self._schedule_prefetch)
+
+    def setModel(self, model):
+        QListView.setModel(self, model)
+        model.rowsInserted.connect(self._schedule_prefetch)
+        model.rowsRemoved.connect(self._schedule_prefetch)
+        model.dataChanged.connect(self._schedule_prefetch)
+        model.modelReset.connect(self._schedule_prefetch)
+
+    def resizeEvent(self, e):
+        QListView.resizeEvent(self, e)
+        self._schedule_prefetch()
+
+    def mouseMoveEvent(self, e):
+        QListView.mouseMoveEvent(self, e)
+        if not self._filmstrips:
+            return
+
+        index = self.indexAt(e.pos())
+        position = None
+        if index.isValid():
+            item = index.data()
+            image_rect = self.itemDelegate().get_image_rect(item['id'])
+            if image_rect:
+                r = image_rect.translated(self.visualRect(index).topLeft())
+                if r.contains(e.pos()):
+                    position = (e.pos().x() - r.left()) / max(1, r.width())
+                    self._want_filmstrip(item, self._hover_index != index)
+
+        self._set_hover(index if position is not None else QModelIndex(), position)
+
+    def leaveEvent(self, e):
+        QListView.leaveEvent(self, e)
+        self._set_hover(QModelIndex(), None)
+
+    def _set_hover(self, index, position):
+        old = self._hover_index
+        self._hover_index = QPersistentModelIndex(index)
+        id = index.data()['id'] if index.isValid() else None
+        self.itemDelegate().set_hover(id, position)
+        if old.isValid():
+            self.update(self.model().index(old.row(), old.column()))
+        if index.isValid():
+            self.update(index)
+
+    def _want_filmstrip(self, item, entered):
+        model = self.model()
+        if isinstance(model, QAbstractProxyModel):
+            model = model.sourceModel()
+
+        if item.get('filmstrip'):
+            height = int(thumbnail_height * self.devicePixelRatioF())
+            model._request_filmstrip(item['id'], height)
+        elif entered and item['id'] not in model._filmstrips_requested:
+            # once per hover, so one that failed is asked for again on
+            # the next rather than on every move
+            model._filmstrips_requested.add(item['id'])
+            self.filmstrip_requested.emit(item['id'])
+
+    def _schedule_prefetch(self, *args):
+        if not self._prefetch_timer.isActive():
+            self._prefetch_timer.start()
+
+    def _prefetch_thumbnails(self):
+        model = self.model()
+        count = model.rowCount(QModelIndex())
+        if not count:
+            return
+
+        rect = self.viewport().rect()
+        first = self.indexAt(rect.topLeft())
+        last = self.indexAt(rect.bottomLeft())
+        first = first.row() if first.isValid() else 0
+        last = last.row() if last.isValid() else count - 1
+
+        margin = self._prefetch_rows
+        ids = []
+        for row in range(max(0, first - margin), min(count, last + margin + 1)):
+            item = model.index(row, 0).data()
+            ids.append(item['id'])
+
+        height = int(thumbnail_height * self.devicePixelRatioF())
+        if isinstance(model, QAbstractProxyModel):
+            model = model.sourceModel()
+        model._request_thumbnails(ids, height)
+
+
+# rows are 128px tall, so there's no point decoding any more than that
+thumbnail_height = 128
+
+
+class ThumbnailDecodeTask(QRunnable):
+    def __init__(self, decoder, id, data, height):
+        QRunnable.__init__(self)
+        self._decoder = decoder
+        self._id = id
+        self._data = data
+        self._height = height
+
+    def run(self):
+        buf = QBuffer()
+        buf.setData(QByteArray(self._data))
+        buf.open(QIODevice.ReadOnly)
+
+        # let the jpeg decoder do the downscaling
+        reader = QImageReader(buf)
+        size = reader.size()
+        if size.isValid() and size.height() > self._height:
+            width = max(1, round(size.width() * self._height / size.height()))
+            reader.setScaledSize(QSize(width, self._height))
+        image = reader.read()
+
+        self._decoder.decoded.emit(self._id, self._data, image)
+
+
+class ThumbnailDecoder(QObject):
+    """Decodes thumbnails on a thread pool. The decoded signal is
+    delivered on the thread the decoder lives on.
+    """
+    decoded = pyqtSignal(str, object, QImage)
+
+    def __init__(self, parent=None):
+        QObject.__init__(self, parent)
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(config['ui'].getint('thumbnail_threads'))
+        self._pending = {}      # id -> data being decoded
+        self.decoded.connect(self._on_decoded)
+
+    def request(self, id, data, height):
+        # new data for an id is decoded even with the old still going,
+        # the old result is stale
+        if self._pending.get(id) is data:
+            return
+        self._pending[id] = data
+        self._pool.start(ThumbnailDecodeTask(self, id, data, height))
+
+    def _on_decoded(self, id, data, image):
+        if self._pending.get(id) is data:
+            del self._pending[id]
+
 
 class MediaListModel(QAbstractListModel):
     def __init__(self, parent=None):
         QAbstractListModel.__init__(self, parent)
         self._items = []
+        self._rows = {}     # id -> row
+
+        # ids with a decoded thumbnail, least recently used first
+        self._images = OrderedDict()
+        self._images_max = config['ui'].getint('thumbnail_cache_size')
+        self._decoder = ThumbnailDecoder(self)
+        self._decoder.decoded.connect(self._on_thumbnail_decoded)
+
+        # the same for filmstrips, which are only decoded on hover. ids
+        # asked of the engine are left until it answers, with a strip
+        # or None, or the item changes
+        self._filmstrips = OrderedDict()
+        self._filmstrips_max = config['filmstrip'].getint('cache_size')
+        self._filmstrips_requested = set()
+        self._filmstrip_decoder = ThumbnailDecoder(self)
+        self._filmstrip_decoder.decoded.connect(self._on_filmstrip_decoded)
 
     def rowCount(self, parent):
         return len(self._items)
@@ -38,6 +213,9 @@ class MediaListModel(QAbstractListModel):
         if role == Qt.DisplayRole:
             row = index.row()
             return (self._items[row])
+        elif role in sort_key_roles:
+            row = index.row()
+            return self._items[row]['_sortkeys'][sort_key_roles[role]]
         else:
             return None
 
@@ -47,16 +225,29 @@ class MediaListModel(QAbstractListModel):
             return False
 
         self.beginRemoveRows(index, row, row+count-1)
-        self._items = items[:row] + items[row+count:]
+        for item in items[row:row+count]:
+            del self._rows[item['id']]
+            self._images.pop(item['id'], None)
+            self._filmstrips.pop(item['id'], None)
+            self._filmstrips_requested.discard(item['id'])
+        del items[row:row+count]
+        self._reindex(row)
         self.endRemoveRows()
         return True
 
+    def _reindex(self, start=0):
+        # rows after a removal have shifted up
+        rows = self._rows
+        items = self._items
+        for row in range(start, len(items)):
+            rows[items[row]['id']] = row
+
     def _find_row_with_id(self, id):
-        for row, item in enumerate(self._items):
-            if item['id'] == id:
-                return row
-        else:
-            return -1
+        return self._rows.get(id, -1)
+
+    def _find_item_with_id(self, id):
+        row = self._rows.get(id)
+        return self._items[row] if row is not None else None
 
     def get_media_id_for_index(self, idx):
         row = idx.row()
@@ -64,92 +255,383 @@ class MediaListModel(QAbstractListModel):
         return item['id']
 
     def _remove_item_by_id(self, id):
-        row = self._find_row_with_id(id)
-        self.removeRow(row)
+        self._remove_items_by_id([id])
 
-    def _update_item(self, data):
-        row = self._find_row_with_id(data['id'])
-        if row < 0:
-            # new item
-            item = data.copy()
-        else:
-            # update item
-            item = self._items[row]
-            item.update(data)
+    def _remove_items_by_id(self, ids):
+        rows = sorted(self._rows[id] for id in set(ids) if id in self._rows)
+        if not rows:
+            return
 
-        # (re-)create display data
-        item['_html'] = format_media_item_html(item)
+        # remove from the bottom up, so earlier rows stay put
+        items = self._items
+        for first, last in reversed(group_row_ranges(rows)):
+            self.beginRemoveRows(QModelIndex(), first, last)
+            for item in items[first:last+1]:
+                del self._rows[item['id']]
+                self._images.pop(item['id'], None)
+                self._filmstrips.pop(item['id'], None)
+                self._filmstrips_requested.discard(item['id'])
+            del items[first:last+1]
+            self.endRemoveRows()
+
+        self._reindex(rows[0])
 
-        if '_image' not in item:
-            image_data = item.get('thumbnail')
-            if image_data:
-                image = QImage()
-                image.loadFromData(image_data)
-                item['_image'] = image
+    def _update_item(self, data):
+        self._apply_updates([data])
+
+    def _apply_updates(self, updates):
+        """Apply a batch of media updates, emitting one signal per
+        contiguous range of changed or inserted rows.
+        """
+        new_items = []
+        new_ids = {}
+        changed_rows = set()
+        touched = {}
+        static_changed = set()
+
+        for data in updates:
+            id = data['id']
+            row = self._rows.get(id, -1)
+            if row >= 0:
+                # update item
+                item = self._items[row]
+                item.update(data)
+                changed_rows.add(row)
+            elif id in new_ids:
+                # new item, updated again within the batch
+                item = new_items[new_ids[id]]
+                item.update(data)
+            else:
+                # new item
+                item = data.copy()
+                new_ids[id] = len(new_items)
+                new_items.append(item)
+            touched[id] = item
+            if 'thumbnail' in data:
+                # stale, decoded again when next visible
+                item.pop('_image', None)
+                self._images.pop(id, None)
+            if 'filmstrip' in data:
+                item.pop('_filmstrip', None)
+                self._filmstrips.pop(id, None)
+            if row < 0 or not data.keys() <= progress_keys:
+                static_changed.add(id)
+                self._filmstrips_requested.discard(id)
+
+        for id, item in touched.items():
+            self._prepare_item(item, id in static_changed)
+
+        for first, last in group_row_ranges(sorted(changed_rows)):
+            self.dataChanged.emit(self.index(first), self.index(last), [])
+
+        if new_items:
+            first = len(self._items)
+            self.beginInsertRows(QModelIndex(), first, first + len(new_items) - 1)
+            self._items.extend(new_items)
+            for row, item in enumerate(new_items, first):
+                self._rows[item['id']] = row
+            self.endInsertRows()
+
+    def _prepare_item(self, item, static_changed=True):
+        if static_changed:
+            # (re-)create display data, and bump the version so the
+            # delegate re-renders it
+            item['_html'] = format_media_item_html(item)
+            item['_sortkeys'] = get_media_item_sort_keys(item)
+            item['_version'] = item.get('_version', 0) + 1
 
         # FIXME
         item['_progress'] = item.get('progress', 0.0)
 
+    def get_distinct_values(self, key):
+        values = set()
+        for item in self._items:
+            value = item.get(key)
+            if value:
+                values.add(tuple(value) if isinstance(value, list) else value)
+        return sorted(values)
+
+    def _request_thumbnails(self, ids, height):
+        """Decode thumbnails for these items, if they aren't already.
+        """
+        images = self._images
+        for id in ids:
+            if id in images:
+                images.move_to_end(id)
+                continue
+            row = self._rows.get(id, -1)
+            if row < 0:
+                continue
+            data = self._items[row].get('thumbnail')
+            if data:
+                self._decoder.request(id, data, height)
+
+    def _on_thumbnail_decoded(self, id, data, image):
+        row = self._rows.get(id, -1)
         if row < 0:
-            row = len(self._items)
-            self.beginInsertRows(QModelIndex(), row, row)
-            self._items.append(item)
-            self.endInsertRows()
+            return
+
+        item = self._items[row]
+        if item.get('thumbnail') is not data:
+            # replaced while decoding
+            return
+
+        # one that can't be decoded is cached without an image, so it
+        # isn't decoded again until it's replaced or dropped
+        if not image.isNull():
+            item['_image'] = image
+            item['_version'] += 1
+        self._images[id] = True
+        self._images.move_to_end(id)
+
+        # drop the least recently shown
+        while len(self._images) > self._images_max:
+            old_id, _ = self._images.popitem(last=False)
+            old_item = self._items[self._rows[old_id]]
+            old_item.pop('_image', None)
+            old_item['_version'] += 1
+
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [])
+
+    def _request_filmstrip(self, id, height):
+        if id in self._filmstrips:
+            self._filmstrips.move_to_end(id)
+            return
+        row = self._rows.get(id, -1)
+        if row >= 0:
+            self._filmstrip_decoder.request(id, self._items[row]['filmstrip'], height)
+
+    def _on_filmstrip_decoded(self, id, data, image):
+        row = self._rows.get(id, -1)
+        if row < 0:
+            return
+
+        item = self._items[row]
+        if item.get('filmstrip') is not data:
+            return
+
+        # drawn over the rendered item, so no new version. one that
+        # can't be decoded is cached without an image, as thumbnails are
+        if not image.isNull():
+            item['_filmstrip'] = image
+        self._filmstrips[id] = True
+        while len(self._filmstrips) > self._filmstrips_max:
+            old_id, _ = self._filmstrips.popitem(last=False)
+            self._items[self._rows[old_id]].pop('_filmstrip', None)
+
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [])
+
+
+# updates with only these keys don't change the rendered item
+progress_keys = {'id', 'progress'}
+
+
+# roles returning an item's precomputed sort keys, so the proxy can
+# compare them without calling back into python for each comparison
+sort_roles = {}
+sort_key_roles = {}
+
+for n, key in enumerate(['name', 'duration', 'filesize', 'state', 'resolution', 'codec']):
+    sort_roles[key] = Qt.UserRole + 1 + n
+    sort_key_roles[Qt.UserRole + 1 + n] = key
+
+state_sort_order = ['error', 'encoding', 'paused', 'queued', 'new', 'ready', 'done']
+
+def get_media_item_sort_keys(item):
+    resolution = item.get('resolution') or (0, 0)
+    state = item.get('state')
+    return {
+        'name': (item.get('displayname') or '').lower(),
+        'duration': float(item.get('duration') or 0.0),
+        'filesize': item.get('filesize') or 0,
+        'state': state_sort_order.index(state) if state in state_sort_order else len(state_sort_order),
+        'resolution': resolution[0] * resolution[1],
+        'codec': item.get('codec') or '',
+        }
+
+
+class MediaListFilterModel(QSortFilterProxyModel):
+    """Filters by state, codec, resolution and name, and sorts on the
+    precomputed keys. Changed rows are re-filtered and re-sorted
+    individually as updates arrive.
+    """
+    def __init__(self, parent=None):
+        QSortFilterProxyModel.__init__(self, parent)
+        self.setDynamicSortFilter(True)
+        self._states = None
+        self._codec = None
+        self._resolution = None
+        self._text = ''
+
+    def set_filter(self, states=None, codec=None, resolution=None, text=''):
+        self._states = set(states) if states else None
+        self._codec = codec
+        self._resolution = tuple(resolution) if resolution else None
+        self._text = text.lower()
+        self.invalidateFilter()
+
+    def is_filtered(self):
+        return bool(self._states or self._codec or self._resolution or self._text)
+
+    def set_sort_key(self, key, descending=False):
+        if not key:
+            # back to the order items were added
+            self.sort(-1)
+            return
+        self.setSortRole(sort_roles[key])
+        self.sort(0, Qt.DescendingOrder if descending else Qt.AscendingOrder)
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        item = self.sourceModel()._items[source_row]
+        if self._states and item.get('state') not in self._states:
+            return False
+        if self._codec and item.get('codec') != self._codec:
+            return False
+        if self._resolution and tuple(item.get('resolution') or ()) != self._resolution:
+            return False
+        if self._text and self._text not in item['_sortkeys']['name']:
+            return False
+        return True
+
+    def get_media_id_for_index(self, idx):
+        return self.sourceModel().get_media_id_for_index(self.mapToSource(idx))
+
+    def get_visible_media_items(self):
+        items = self.sourceModel()._items
+        return [items[self.mapToSource(self.index(row, 0)).row()]
+                for row in range(self.rowCount())]
+
+
+def group_row_ranges(rows):
+    """Group sorted rows into contiguous (first, last) ranges.
+    """
+    ranges = []
+    for row in rows:
+        if ranges and ranges[-1][1] == row - 1:
+            ranges[-1][1] = row
         else:
-            index = self.index(row)
-            self.dataChanged.emit(index, index, [])
+            ranges.append([row, row])
+    return ranges
 
 
 class MediaItemDelegate(QStyledItemDelegate):
+    """Paints items from a cache of pre-rendered pixmaps (text and
+    thumbnail), keyed by item version and size. Progress and selection
+    are drawn over the top.
+    """
     def __init__(self, parent=None):
         QStyledItemDelegate.__init__(self, parent)
+        self._cache = OrderedDict()     # id -> (key, pixmap, image rect)
+        self._cache_size = config['ui'].getint('render_cache_size')
+        self._hover = (None, None)      # id, position across the thumbnail
+
+    def set_hover(self, id, position):
+        self._hover = (id, position)
+
+    def get_image_rect(self, id):
+        cached = self._cache.get(id)
+        return cached[2] if cached else None
 
     def paint(self, painter, option, index):
         item = index.data()
 
+        pixmap, image_rect = self._get_rendered_item(item, option)
+
         painter.save()
+        painter.drawPixmap(option.rect.topLeft(), pixmap)
+
+        hover_id, position = self._hover
+        if hover_id == item['id'] and image_rect:
+            self._draw_filmstrip(painter, item, image_rect.translated(option.rect.topLeft()), position)
+
+        progress = item.get('_progress', 0.0)
+        if progress > 0.0 and image_rect:
+            r = image_rect.translated(option.rect.topLeft())
+            r.setHeight(25)
+            b = 2
+            r.adjust(b, b, -b, -b)
+            self._draw_progress(painter, r, progress)
+
+        if (int(option.state) & QStyle.State_Selected) != 0:
+            painter.setCompositionMode(painter.CompositionMode_Multiply)
+            painter.fillRect(option.rect, option.palette.highlight())
+
+        painter.restore()
+
+    def _get_rendered_item(self, item, option):
+        id = item['id']
+        size = option.rect.size()
+        dpr = option.widget.devicePixelRatioF() if option.widget else 1.0
+        key = (item.get('_version'), size.width(), size.height(), dpr)
+
+        cache = self._cache
+        cached = cache.get(id)
+        if cached and cached[0] == key:
+            cache.move_to_end(id)
+            return cached[1], cached[2]
+
+        pixmap, image_rect = self._render_item(item, size, dpr)
+        cache[id] = (key, pixmap, image_rect)
+        cache.move_to_end(id)
+        while len(cache) > self._cache_size:
+            cache.popitem(last=False)
+        return pixmap, image_rect
+
+    def _render_item(self, item, size, dpr):
+        pixmap = QPixmap(size * dpr)
+        pixmap.setDevicePixelRatio(dpr)
+        pixmap.fill(Qt.transparent)
+
+        painter = QPainter(pixmap)
 
         html = item.get('_html')
         if html:
             doc = QTextDocument()
             doc.setHtml(html)
-            painter.save()
-            painter.translate(option.rect.topLeft())
             doc.drawContents(painter)
-            painter.restore()
 
+        image_rect = None
         image = item.get('_image')
         if image and image.width() and image.height():  # XXX
-            rect = QRect(option.rect)
+            rect = QRect(QPoint(0, 0), size)
             rect.adjust(0, 0, 0, -1)
             aspect = float(image.width()) / image.height()
             rect.setWidth(int(rect.height() * aspect))
-            rect.moveTopRight(option.rect.topRight())
+            rect.moveTopRight(QPoint(size.width() - 1, 0))
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
             painter.drawImage(rect, image)
-
-            progress = item.get('_progress', 0.0)
-            if progress > 0.0:
-                r = QRect(rect)
-                r.setHeight(25)
-                b = 2
-                r.adjust(b, b, -b, -b)
-
-                o = QStyleOptionProgressBar()
-                o.minimum = 0
-                o.maximum = 100
-                o.progress = round(100 * progress)
-                o.textAlignment = Qt.AlignCenter
-                o.text = f'{o.progress}%'
-                o.textVisible = True
-                o.rect = r
-                painter.setOpacity(0.75)
-                qApp.style().drawControl(QStyle.CE_ProgressBar, o, painter)
-
-        if (int(option.state) & QStyle.State_Selected) != 0:
-            painter.setCompositionMode(painter.CompositionMode_Multiply)
-            painter.fillRect(option.rect, option.palette.highlight())
-
-        painter.restore()
+            image_rect = rect
+
+        painter.end()
+        return pixmap, image_rect
+
+    def _draw_filmstrip(self, painter, item, rect, position):
+        strip = item.get('_filmstrip')
+        frames = item.get('filmstrip_frames')
+        if not strip or not frames:
+            return
+
+        # the frame under the cursor
+        n = min(frames - 1, max(0, int(position * frames)))
+        width = strip.width() / frames
+        source = QRect(round(n * width), 0, round(width), strip.height())
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.drawImage(rect, strip, source)
+
+    def _draw_progress(self, painter, rect, progress):
+        percent = round(100 * progress)
+        palette = qApp.palette()
+
+        painter.setOpacity(0.75)
+        painter.fillRect(rect, palette.base())
+        bar = QRect(rect)
+        bar.setWidth(int(rect.width() * progress))
+        painter.fillRect(bar, palette.highlight())
+        painter.setOpacity(1.0)
+        painter.setPen(palette.text().color())
+        painter.drawText(rect, Qt.AlignCenter, f'{percent}%')
 
     def sizeHint(self, option, index):
         return QSize(128, 128)
@@ -161,6 +643,7 @@ state_colors = {
     'error': 'red',
     'encoding': 'blue',
     'queued': 'orange',
+    'paused': 'purple',
     }
 
 def format_media_item_html(item):
@@ -194,6 +677,8 @@ def format_media_item_html(item):
 
         if filesize:
             deets.append(f'{format_size(filesize)}')
+        if item.get('duplicate_of'):
+            deets.append('<i>duplicate</i>')
 
         if state and state != 'ready':
             color = state_colors.get(state, 'auto')
@@ -207,6 +692,8 @@ def format_media_item_html(item):
             deets.append(f'Duration: {duration:.02f}s')
         if filesize:
             deets.append(f'Size: {format_size(filesize)}')
+        if item.get('duplicate_of'):
+            deets.append('Duplicate of another item')
         if state:
             deets.append(f'State: {state}')
 
@@ -0,0 +1,104 @@
+"""Read-ahead for image sequence inputs.
+
+ffmpeg's image2 demuxer opens and reads one frame at a time, which on
+network storage leaves the encoder waiting on each round trip. The
+prefetcher keeps a window of frames ahead of ffmpeg's reported position
+in flight on a few threads, so they're in the page cache by the time
+ffmpeg opens them.
+"""
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import config
+
+log = logging.getLogger('engine.prefetch')
+
+cfg = config['prefetch']
+
+read_chunk_size = 1024 * 1024
+
+
+def is_enabled():
+    return cfg.getboolean('enabled')
+
+def get_prefetch_mode():
+    mode = cfg.get('mode')
+    if mode == 'fadvise' and not hasattr(os, 'posix_fadvise'):
+        # windows and macos
+        mode = 'read'
+    return mode
+
+
+class SequencePrefetcher(object):
+    """Prefetches a list of frame files, at most 'window' frames ahead
+    of the position passed to advance().
+    """
+    def __init__(self, filepaths, window=None, threads=None, mode=None):
+        self.filepaths = filepaths
+        self.window = window or cfg.getint('window')
+        self.mode = mode or get_prefetch_mode()
+        self.frames = 0
+        self.bytes = 0
+
+        self._next = 0
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(
+            max_workers=threads or cfg.getint('threads'),
+            thread_name_prefix='prefetch')
+
+    def advance(self, position=0):
+        # frames ffmpeg has already read aren't worth fetching
+        self._next = max(self._next, position)
+        end = min(len(self.filepaths), position + self.window)
+        while self._next < end:
+            self._executor.submit(self._prefetch, self.filepaths[self._next])
+            self._next += 1
+
+    def stop(self):
+        self._stopped = True
+        self._executor.shutdown(wait=False)
+        log.debug(f'prefetched {self.frames}/{len(self.filepaths)} frames, {self.bytes} bytes ({self.mode})')
+
+    def _prefetch(self, filepath):
+        if self._stopped:
+            return
+        try:
+            if self.mode == 'fadvise':
+                nbytes = self._fadvise(filepath)
+            else:
+                nbytes = self._read(filepath)
+        except OSError as e:
+            # ffmpeg will report it properly
+            log.debug(f'prefetch failed: {filepath}: {e}')
+            return
+
+        with self._lock:
+            self.frames += 1
+            self.bytes += nbytes
+
+    def _fadvise(self, filepath):
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            return os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+
+    def _read(self, filepath):
+        # read through a per-thread buffer, only the page cache keeps it
+        buf = getattr(self._local, 'buf', None)
+        if buf is None:
+            buf = self._local.buf = bytearray(read_chunk_size)
+
+        nbytes = 0
+        with open(filepath, 'rb', buffering=0) as f:
+            while not self._stopped:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                nbytes += n
+        return nbytes
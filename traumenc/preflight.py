@@ -0,0 +1,164 @@
+import os
+import shutil
+import socket
+import logging
+import sqlite3
+
+import clique
+
+from config import config
+from encodingprofiles import get_profile_bytes_per_pixel
+from utils import format_size
+import history
+import publish
+
+log = logging.getLogger('engine.preflight')
+
+cfg = config['preflight']
+
+
+def get_free_space(dirpath):
+    if hasattr(os, 'statvfs'):
+        st = os.statvfs(dirpath)
+        return st.f_bavail * st.f_frsize
+    # windows
+    return shutil.disk_usage(dirpath).free
+
+def get_item_frame_count(item):
+    if item['type'] == 'sequence':
+        seq = clique.parse(item['path'])
+        return len(seq.indexes)
+
+    # videos are encoded at their own rate
+    num, den = item['framerate']
+    if not den:
+        return 0
+    return int(round(item['duration'] * num / den))
+
+def get_calibrated_rates():
+    """Per-profile rates measured on this host, from the encode history.
+    """
+    if not history.is_enabled():
+        return {}
+    try:
+        db = history.get_history_db()
+        return history.query_profile_rates(db, host=socket.gethostname())
+    except sqlite3.Error as e:
+        log.warning(f'cannot read encode history: {e}')
+        return {}
+
+def get_max_scratch_jobs():
+    # the encodes running at once, and the one being published
+    if config['governor'].getboolean('enabled'):
+        max_jobs = config['governor'].getint('max_jobs') or os.cpu_count()
+    else:
+        max_jobs = config['engine'].getint('max_jobs')
+    return max_jobs + 1
+
+def get_volume(volumes, dirpath):
+    try:
+        dev = os.stat(dirpath).st_dev
+    except OSError:
+        log.warning(f'cannot stat {dirpath}')
+        return None
+
+    volume = volumes.get(dev)
+    if not volume:
+        volume = volumes[dev] = {
+            'path': dirpath,
+            'bytes': 0,
+            'free': get_free_space(dirpath),
+            }
+    return volume
+
+def estimate_encode(jobs, profile):
+    """Estimate output size and encode time for a list of
+    (item, outpath) jobs, grouped by output volume. With a scratch dir,
+    its volume needs room for the largest outputs that can be there at
+    once.
+    """
+    rates = get_calibrated_rates().get(profile, {})
+    bytes_per_pixel = rates.get('bytes_per_pixel') or get_profile_bytes_per_pixel(profile)
+    pixel_rate = rates.get('pixel_rate')
+
+    total_bytes = 0
+    total_pixels = 0
+    volumes = {}
+    sizes = []
+
+    for item, outpath in jobs:
+        width, height = item['resolution']
+        pixels = width * height * get_item_frame_count(item)
+        nbytes = int(pixels * bytes_per_pixel)
+        total_pixels += pixels
+        total_bytes += nbytes
+        sizes.append(nbytes)
+
+        volume = get_volume(volumes, os.path.dirname(outpath))
+        if not volume:
+            continue
+
+        # overwriting an existing output frees its space
+        if os.path.isfile(outpath):
+            nbytes -= os.path.getsize(outpath)
+        volume['bytes'] += nbytes
+
+    try:
+        scratch_dir = publish.get_scratch_dir()
+    except OSError as e:
+        log.warning(f'cannot create scratch dir: {e}')
+        scratch_dir = None
+    if scratch_dir:
+        volume = get_volume(volumes, scratch_dir)
+        if volume:
+            sizes.sort(reverse=True)
+            volume['bytes'] += sum(sizes[:get_max_scratch_jobs()])
+
+    return {
+        'profile': profile,
+        'items': len(jobs),
+        'bytes': total_bytes,
+        'seconds': total_pixels / pixel_rate if pixel_rate else None,
+        'calibrated': bool(rates),
+        'volumes': list(volumes.values()),
+        }
+
+def check_free_space(estimate):
+    """Return a list of problems with volumes that would be (nearly) filled.
+    """
+    reserve = cfg.getint('reserve_mb') * 1024 * 1024
+    problems = []
+    for volume in estimate['volumes']:
+        needed = volume['bytes'] + reserve
+        if needed > volume['free']:
+            problems.append(
+                f'{volume["path"]}: needs {format_size(volume["bytes"])}, '
+                f'{format_size(volume["free"])} free')
+    return problems
+
+def format_estimate(estimate):
+    text = f'{estimate["items"]} items, ~{format_size(estimate["bytes"])}'
+    seconds = estimate['seconds']
+    if seconds is not None:
+        hh, rem = divmod(int(seconds), 3600)
+        mm, ss = divmod(rem, 60)
+        text += f', ~{hh}:{mm:02}:{ss:02}'
+    return text
+
+def run_preflight(jobs, profile):
+    """Returns (ok, estimate, problems). Not ok only when a volume is
+    short of space and the mode is 'refuse'.
+    """
+    mode = cfg.get('mode')
+    if mode == 'off':
+        return True, None, []
+
+    estimate = estimate_encode(jobs, profile)
+    problems = check_free_space(estimate)
+
+    log.info(f'preflight: {format_estimate(estimate)}')
+    for problem in problems:
+        log.warning(f'preflight: {problem}')
+
+    ok = not (problems and mode == 'refuse')
+    return ok, estimate, problems
@@ -0,0 +1,193 @@
+import os
+import time
+import json
+import threading
+import logging
+import collections
+
+from config import config
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, no child cpu times
+    resource = None
+
+log = logging.getLogger('engine.profile')
+
+cfg = config['profile']
+enabled = cfg.getboolean('enabled')
+
+# chrome trace events, see:
+# https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+# only the most recent are kept, a long running app would fill memory
+trace_events = collections.deque(maxlen=max(1, cfg.getint('trace_events')))
+
+# aggregate stats per stage: name -> [count, total, min, max]
+stage_stats = {}
+
+trace_t0 = time.perf_counter()
+
+# the spans open on each thread, innermost last
+open_spans = threading.local()
+
+
+def get_child_cpu_time():
+    if not resource:
+        return 0.0
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return ru.ru_utime + ru.ru_stime
+
+
+def record(name, elapsed):
+    """Add a duration (in seconds) to the aggregate stats for a stage.
+    """
+    stats = stage_stats.get(name)
+    if stats is None:
+        stage_stats[name] = [1, elapsed, elapsed, elapsed]
+    else:
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = min(stats[2], elapsed)
+        stats[3] = max(stats[3], elapsed)
+
+
+class Span(object):
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def set(self, **kwargs):
+        self.args.update(kwargs)
+
+    def __enter__(self):
+        stack = getattr(open_spans, 'stack', None)
+        if stack is None:
+            stack = open_spans.stack = []
+        stack.append(self)
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        t1 = time.perf_counter()
+        elapsed = t1 - self._t0
+        open_spans.stack.remove(self)
+
+        record(self.name, elapsed)
+        add_trace_event(self.name, self._t0, elapsed, self.args)
+        return False
+
+
+def add_trace_event(name, t0, elapsed, args):
+    trace_events.append({
+        'name': name,
+        'cat': name.split('.')[0],
+        'ph': 'X',
+        'ts': round((t0 - trace_t0) * 1e6),
+        'dur': round(elapsed * 1e6),
+        'pid': os.getpid(),
+        'tid': threading.get_ident(),
+        'args': args,
+        })
+
+
+class NullSpan(object):
+    def set(self, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+null_span = NullSpan()
+
+
+def span(name, **args):
+    """Time a block of code, eg:
+
+        with span('probe_item', id=id):
+            ...
+
+    Returns a shared do-nothing span when profiling is disabled.
+    """
+    if not enabled:
+        return null_span
+    return Span(name, args)
+
+
+def add_child_cpu(seconds):
+    """Charge the cpu time of a process just waited on to the innermost
+    span open on this thread. RUSAGE_CHILDREN can't be used per span, it
+    grows by whichever child anything reaps.
+    """
+    if not enabled:
+        return
+    stack = getattr(open_spans, 'stack', None)
+    if stack:
+        args = stack[-1].args
+        args['child_cpu'] = round(args.get('child_cpu', 0.0) + seconds, 6)
+
+
+def add_span(name, t0, **args):
+    """Record a span from t0 (a time.perf_counter()) until now, for
+    work that isn't one block of code, eg a process waited on later.
+    """
+    if not enabled:
+        return
+    elapsed = time.perf_counter() - t0
+    record(name, elapsed)
+    add_trace_event(name, t0, elapsed, args)
+
+
+def timed_iter(name, iterable):
+    """Wrap an iterator, recording the time taken by each step.
+    """
+    if not enabled:
+        return iterable
+
+    def gen():
+        it = iter(iterable)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                x = next(it)
+            except StopIteration:
+                return
+            record(name, time.perf_counter() - t0)
+            yield x
+    return gen()
+
+
+def write_trace(filepath=None):
+    if not filepath:
+        filepath = cfg.get('trace_file')
+    if not filepath:
+        return
+
+    log.info(f'writing trace ({len(trace_events)} events) to {filepath}')
+    with open(filepath, 'w') as f:
+        json.dump({
+            'traceEvents': list(trace_events),
+            'displayTimeUnit': 'ms',
+            }, f)
+
+
+def format_stage_stats():
+    lines = [f'{"stage":30} {"count":>8} {"total":>10} {"mean":>10} {"min":>10} {"max":>10}']
+    for name, (count, total, tmin, tmax) in sorted(
+            stage_stats.items(), key=lambda x: -x[1][1]):
+        mean = total / count
+        lines.append(f'{name:30.30} {count:8} {total:10.3f} {mean:10.4f} {tmin:10.4f} {tmax:10.4f}')
+    return '\n'.join(lines)
+
+
+def report():
+    """Log per-stage stats and write out the trace file.
+    """
+    if not enabled:
+        return
+
+    log.info('stage stats (seconds):\n' + format_stage_stats())
+    write_trace()
@@ -0,0 +1,153 @@
+"""Scratch output and publishing.
+
+With [engine] scratch_dir set, ffmpeg writes to fast local disk and the
+finished file is moved to its destination in the background while the
+next encode runs. Without one, ffmpeg writes to a hidden temp name
+alongside the destination instead. Either way files only appear at the
+destination complete, renamed into place, so an existing output is never
+written into or lost to a failed encode.
+"""
+import os
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from config import config
+
+log = logging.getLogger('engine.publish')
+
+cfg = config['engine']
+
+# one transfer at a time, they compete for the same links
+publish_executor = None
+
+# linux ioctl to share extents between files (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def get_scratch_dir():
+    dirpath = cfg.get('scratch_dir')
+    if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
+    return dirpath
+
+def get_scratch_path(id, outpath):
+    """Where to encode an item when publishing to outpath, a temp name
+    alongside it when there's no scratch dir.
+    """
+    dirpath = get_scratch_dir()
+    if not dirpath:
+        return get_partial_path(outpath)
+    return os.path.join(dirpath, f'{id}_{os.path.basename(outpath)}')
+
+def get_partial_path(outpath):
+    # keeps the extension, ffmpeg picks the format by it
+    dirpath, filename = os.path.split(outpath)
+    return os.path.join(dirpath, f'.partial.{os.getpid()}.{filename}')
+
+def remove_partial(filepath):
+    try:
+        os.remove(filepath)
+        log.info(f'removed partial output: {filepath}')
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        log.warning(f'cannot remove partial output: {filepath}: {e}')
+
+def publish_output(srcpath, outpath):
+    """Move a finished encode into place atomically.
+    """
+    try:
+        # same filesystem, just rename
+        os.replace(srcpath, outpath)
+        return
+    except OSError:
+        pass
+
+    partialpath = get_partial_path(outpath)
+    try:
+        shutil.copyfile(srcpath, partialpath)
+        # opened for writing, windows won't flush a read-only handle
+        with open(partialpath, 'r+b') as f:
+            os.fsync(f.fileno())
+        os.replace(partialpath, outpath)
+    except OSError:
+        # keep the encode, only the copy failed
+        remove_partial(partialpath)
+        raise
+
+    try:
+        os.remove(srcpath)
+    except OSError:
+        pass
+
+def reflink_file(srcpath, dstpath):
+    if not fcntl or not hasattr(fcntl, 'ioctl'):
+        raise OSError('reflinks not supported')
+    with open(srcpath, 'rb') as src, open(dstpath, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def clone_file(srcpath, dstpath, hardlink=True):
+    """Reflink, hardlink or copy, whichever works first. Returns which.
+    """
+    try:
+        reflink_file(srcpath, dstpath)
+        return 'reflink'
+    except OSError:
+        # leaves an empty file behind
+        if os.path.exists(dstpath):
+            os.remove(dstpath)
+
+    if hardlink:
+        try:
+            os.link(srcpath, dstpath)
+            return 'hardlink'
+        except OSError:
+            pass
+
+    shutil.copyfile(srcpath, dstpath)
+    return 'copy'
+
+def link_output(srcpath, outpath):
+    """Give a copy of a source its own output, hardlinked where
+    possible, replacing whatever was there atomically.
+    """
+    partialpath = get_partial_path(outpath)
+    try:
+        clone_file(srcpath, partialpath)
+        os.replace(partialpath, outpath)
+    except OSError:
+        remove_partial(partialpath)
+        raise
+
+def run_transfer_async(transfer, srcpath, outpath, callback):
+    """Run transfer(srcpath, outpath) in the background, then call
+    callback(error) from the transfer thread, error being None on
+    success.
+    """
+    global publish_executor
+    if publish_executor is None:
+        publish_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='publish')
+
+    def run():
+        log.info(f'{transfer.__name__}: {srcpath} -> {outpath}')
+        try:
+            transfer(srcpath, outpath)
+        except OSError as e:
+            log.error(f'{transfer.__name__} failed: {outpath}: {e}')
+            callback(e)
+        else:
+            callback(None)
+
+    publish_executor.submit(run)
+
+def publish_output_async(srcpath, outpath, callback):
+    run_transfer_async(publish_output, srcpath, outpath, callback)
+
+def link_output_async(srcpath, outpath, callback):
+    run_transfer_async(link_output, srcpath, outpath, callback)
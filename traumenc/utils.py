@@ -1,5 +1,12 @@
+import os
 import re
+import copy
+import time
+import queue
 import logging
+import logging.handlers
+import threading
+import collections
 from config import config
 
 
@@ -12,11 +19,134 @@ def format_size(num, suffix='B'):
     return "%.1f%s%s" % (num, 'Yi', suffix)
 
 
+max_rate_limit_types = 1000
+
+# pass as extra= from hot loops, to log only one in [log] sample of them
+SAMPLED = {'sampled': True}
+
+
+class RateLimitFilter(logging.Filter):
+    """Limits each type of message, a logger and format string (so log
+    with %-style args, not f-strings), to a rate per second, and passes
+    only one in so many of those logged with extra=SAMPLED. Warnings and
+    worse always pass. The next message of a type to pass says how many
+    were dropped. Called from any thread that logs.
+    """
+    def __init__(self, rate, burst, sample):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.burst = burst
+        self.sample = sample
+        self.reset()
+
+    def reset(self):
+        # a new lock too, one held by another thread at a fork stays held
+        self.lock = threading.Lock()
+        self.buckets = {}   # type -> (tokens, last time)
+        self.seen = collections.Counter()
+        self.suppressed = collections.Counter()
+        self.total_suppressed = collections.Counter()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        with self.lock:
+            return self._filter(record)
+
+    def _filter(self, record):
+        key = (record.name, record.msg)
+        if self.sample > 1 and getattr(record, 'sampled', False):
+            self.seen[key] += 1
+            if self.seen[key] % self.sample != 1:
+                return self._suppress(key)
+
+        if self.rate > 0:
+            now = time.monotonic()
+            if len(self.buckets) > max_rate_limit_types:
+                self._prune(now)
+            tokens, last = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1.0:
+                self.buckets[key] = (tokens, now)
+                return self._suppress(key)
+            self.buckets[key] = (tokens - 1.0, now)
+
+        n = self.suppressed.pop(key, 0)
+        if n:
+            record.msg = f'{record.msg} [{n} suppressed]'
+        return True
+
+    def _prune(self, now):
+        # f-string messages are all different types, forget the ones
+        # whose buckets have refilled
+        full = self.burst / self.rate
+        self.buckets = {key: bucket for key, bucket in self.buckets.items()
+                        if now - bucket[1] < full}
+        if len(self.buckets) > max_rate_limit_types // 2:
+            # too many at once, start afresh rather than prune every call
+            self.buckets.clear()
+
+    def _suppress(self, key):
+        self.suppressed[key] += 1
+        self.total_suppressed[key] += 1
+        return False
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Queues a copy of each record with its message and traceback
+    formatted in the caller, while the args and frames are still as
+    logged. The rest of the formatting happens on the listener's thread.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+log_listener = None
+log_listener_pid = None
+log_queue_handler = None
+
+
+def start_log_listener(handlers):
+    global log_listener, log_listener_pid
+    log_queue_handler.queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue_handler.queue, *handlers, respect_handler_level=True)
+    log_listener.start()
+    log_listener_pid = os.getpid()
+
+def stop_logging():
+    """Report what was suppressed, then write out anything queued. Call
+    before exiting, the listener thread doesn't outlive the process.
+    """
+    global log_listener
+    if not log_listener or log_listener_pid != os.getpid():
+        return
+
+    limits = [f for f in log_queue_handler.filters if isinstance(f, RateLimitFilter)]
+    if limits and limits[0].total_suppressed:
+        lines = [f'{n:8} {name}: {msg}' for (name, msg), n in limits[0].total_suppressed.most_common(10)]
+        logging.getLogger('log').info('suppressed messages:\n' + '\n'.join(lines))
+
+    log_listener.stop()
+    log_listener = None
+
 def setup_logging(color=False):
+    global log_queue_handler
 
     root = logging.root
     if root.hasHandlers():
-        # already setup
+        # already setup, but a forked process needs its own listener
+        if log_listener and log_listener_pid != os.getpid():
+            for f in log_queue_handler.filters:
+                f.reset()
+            start_log_listener(log_listener.handlers)
         return
 
     datefmt = '%H:%M:%S'
@@ -50,6 +180,17 @@ def setup_logging(color=False):
     level = getattr(logging, cfg.get('level', 'debug').upper())
     root.setLevel(level)
 
+    if cfg.getboolean('queue') and root.handlers:
+        # write from a background thread, behind a rate limit
+        handlers = list(root.handlers)
+        for handler in handlers:
+            root.removeHandler(handler)
+        log_queue_handler = LogQueueHandler(None)
+        log_queue_handler.addFilter(RateLimitFilter(
+            cfg.getfloat('rate_limit'), cfg.getfloat('burst'), cfg.getint('sample')))
+        root.addHandler(log_queue_handler)
+        start_log_listener(handlers)
+
     return logging
 
 
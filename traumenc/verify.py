@@ -0,0 +1,194 @@
+"""Post-encode verification.
+
+Finished outputs are checked in a small pool while further encodes run:
+the packet (and for intra-only profiles, decoded frame) count and
+duration ffprobe reports are compared with the source, the timecode
+with what was asked for, and a checksum is taken
+while the file is still in the page cache. Each batch of encodes gets
+a json manifest of the results.
+"""
+import os
+import json
+import time
+import socket
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+from config import config
+
+log = logging.getLogger('engine.verify')
+
+cfg = config['verify']
+
+checksum_chunk_size = 4 * 1024 * 1024
+
+verify_executor = None
+
+
+def is_enabled():
+    return cfg.getboolean('enabled')
+
+def get_checksum_type():
+    checksum = cfg.get('checksum')
+    if checksum == 'xxhash' and not xxhash:
+        log.warning('xxhash not installed, using md5')
+        return 'md5'
+    return checksum
+
+def get_checksum(filepath, checksum):
+    if checksum == 'xxhash':
+        h = xxhash.xxh64()
+    else:
+        h = hashlib.new(checksum)
+
+    with open(filepath, 'rb') as f:
+        while True:
+            data = f.read(checksum_chunk_size)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def check_output(outpath, probe, frames, duration, timecode, frame_period=0.0):
+    """Check an output against the expected frame count, duration (in
+    seconds) and timecode. Returns the result for the manifest, with a
+    list of any problems found.
+
+    The duration may be out by up to a frame (frame_period seconds),
+    containers round variable frame rates and audio padding differently.
+    With frames and duration None (a source that didn't say), only the
+    timecode and checksum are checked.
+    """
+    problems = []
+    result = {
+        'output': outpath,
+        'expected_frames': frames,
+        'expected_duration': duration,
+        'problems': problems,
+        }
+
+    try:
+        result['bytes'] = os.path.getsize(outpath)
+        info = probe(outpath)
+    except Exception as e:
+        problems.append(f'cannot probe output: {e}')
+        return result
+
+    streams = info.get('streams') or [{}]
+    stream = streams[0]
+    tags = dict(info.get('format', {}).get('tags', {}))
+    tags.update(stream.get('tags', {}))
+
+    packets = int(stream.get('nb_read_packets', 0))
+    result['frames'] = packets
+    if frames is not None and packets != frames:
+        problems.append(f'{packets} frames, expected {frames}')
+
+    if 'nb_read_frames' in stream:
+        # decoded too, a packet can be there and still not decode
+        decoded = int(stream['nb_read_frames'])
+        result['decoded_frames'] = decoded
+        if frames is not None and decoded != frames:
+            problems.append(f'{decoded} frames decoded, expected {frames}')
+
+    try:
+        out_duration = float(stream.get('duration') or info['format']['duration'])
+    except (KeyError, ValueError):
+        out_duration = None
+    result['duration'] = out_duration
+    if out_duration is None:
+        problems.append('no duration')
+    elif duration is not None and abs(out_duration - duration) > max(cfg.getfloat('duration_tolerance'), frame_period):
+        problems.append(f'duration {out_duration:.3f}s, expected {duration:.3f}s')
+
+    result['timecode'] = tags.get('timecode')
+    if timecode and tags.get('timecode') != timecode:
+        problems.append(f'timecode {tags.get("timecode")}, expected {timecode}')
+
+    checksum = get_checksum_type()
+    if checksum != 'none':
+        t0 = time.perf_counter()
+        try:
+            result['checksum'] = get_checksum(outpath, checksum)
+            result['checksum_type'] = checksum
+        except OSError as e:
+            problems.append(f'cannot read output: {e}')
+        log.debug(f'{checksum} {outpath}: {time.perf_counter() - t0:.3f}s')
+
+    return result
+
+def verify_output_async(outpath, probe, frames, duration, timecode, frame_period, callback):
+    """Check an output in the pool, then call callback(result) from
+    the worker thread.
+    """
+    global verify_executor
+    if verify_executor is None:
+        verify_executor = ThreadPoolExecutor(
+            max_workers=cfg.getint('threads'),
+            thread_name_prefix='verify')
+
+    def run():
+        result = check_output(outpath, probe, frames, duration, timecode, frame_period)
+        for problem in result['problems']:
+            log.error(f'verify failed: {outpath}: {problem}')
+        callback(result)
+
+    verify_executor.submit(run)
+
+
+class Manifest(object):
+    """The verification results of one batch of encodes.
+    """
+    def __init__(self, profile):
+        self.profile = profile
+        self.time = time.time()
+        self.results = []
+
+    def add(self, item, result):
+        entry = {
+            'id': item['id'],
+            'source': item['path'],
+            }
+        entry.update(result)
+        entry['ok'] = not result['problems']
+        self.results.append(entry)
+
+    def get_filepath(self):
+        dirpath = cfg.get('manifest_dir')
+        if not dirpath:
+            # alongside the first output
+            dirpath = os.path.dirname(self.results[0]['output'])
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.time))
+        return os.path.join(dirpath, f'traumenc-manifest-{stamp}.json')
+
+    def write(self):
+        if not self.results:
+            return None
+
+        ob = {
+            'time': self.time,
+            'host': socket.gethostname(),
+            'profile': self.profile,
+            'items': len(self.results),
+            'failed': sum(1 for entry in self.results if not entry['ok']),
+            'results': self.results,
+            }
+
+        filepath = self.get_filepath()
+        temppath = f'{filepath}.tmp'
+        try:
+            with open(temppath, 'w') as f:
+                json.dump(ob, f, indent=2)
+            os.replace(temppath, filepath)
+        except OSError as e:
+            log.error(f'cannot write manifest: {filepath}: {e}')
+            return None
+
+        log.info(f'wrote manifest: {filepath}')
+        return filepath